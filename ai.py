@@ -1,21 +1,45 @@
 import html
 import logging
+import logging.handlers
+import queue
+import atexit
+import contextlib
+import contextvars
 import asyncio
 import os
 import re
 import json
+import copy
+import random
+import io
+import tempfile
+import hashlib
+import unicodedata
 import sys
+import signal
+import socket
 import time
+from collections import OrderedDict, deque
+from types import MappingProxyType
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import aiosqlite
+import groq
 from groq import AsyncGroq
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, CommandObject
 from aiogram.types import (ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup,
-                           InlineKeyboardButton, FSInputFile, CallbackQuery)
+                           InlineKeyboardButton, BufferedInputFile, CallbackQuery)
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode, ContentType
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramNotFound
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from pptx import Presentation
 from pptx.util import Inches, Pt
 from pptx.dml.color import RGBColor
@@ -27,14 +51,106 @@ import pypdf
 from docx import Document
 
 # --- 1. KONFIGURATSIYA VA LOGGING ---
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
+# Log yozuvlari navbatga tushadi, diskka alohida thread yozadi (event loop bloklanmaydi)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')   # masalan 'midnight' - vaqt bo'yicha; bo'sh - hajm bo'yicha
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1'
+LOG_DEDUP_INTERVAL = float(os.getenv('LOG_DEDUP_INTERVAL', '60'))  # bir xil WARNING/ERROR'lar oralig'i
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s%(ctx)s - %(message)s"
+
+# update/user/job korrelyatsiya id'lari (har bir asyncio task o'z nusxasiga ega)
+log_context = contextvars.ContextVar('log_context', default=None)
+
+def bind_log_context(**fields):
+    ctx = dict(log_context.get() or {})
+    ctx.update(fields)
+    log_context.set(ctx)
+
+class ContextFilter(logging.Filter):
+    """Yozuvga joriy task'ning korrelyatsiya id'larini qo'shadi (yozuv yaratilgan thread'da ishlaydi)"""
+    def filter(self, record):
+        ctx = log_context.get() or {}
+        record.context = ctx
+        record.ctx = "".join(f" [{k}={v}]" for k, v in ctx.items() if v is not None)
+        return True
+
+class DedupFilter(logging.Filter):
+    """Bir xil WARNING/ERROR'ni interval ichida faqat bir marta o'tkazadi, keyingisida takrorlar sonini qo'shadi"""
+    def __init__(self, interval, maxsize=1000):
+        super().__init__()
+        self.interval = interval
+        self.maxsize = maxsize
+        self._seen = {}  # (daraja, logger, xabar) -> [birinchi vaqt, yashirilganlar soni]
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.interval <= 0:
+            return True
+        now = time.monotonic()
+        key = (record.levelno, record.name, record.getMessage())
+        seen = self._seen.get(key)
+        if seen and now - seen[0] < self.interval:
+            seen[1] += 1
+            self.suppressed += 1
+            return False
+        if seen and seen[1]:
+            record.msg = f"{record.getMessage()} (oxirgi {self.interval:.0f}s da yana {seen[1]} marta)"
+            record.args = None
+        if len(self._seen) >= self.maxsize:
+            self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+        self._seen[key] = [now, 0]
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            **getattr(record, 'context', {})
+        }
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Navbat to'lsa kutmaydi - yozuv tashlab yuboriladi va hisoblanadi"""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler(), file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.dedup = DedupFilter(LOG_DEDUP_INTERVAL)
+    queue_handler.addFilter(queue_handler.dedup)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler
+
+log_queue_handler = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Environment variable'lardan o'qish
@@ -59,10 +175,221 @@ except ValueError:
     ADMIN_ID = 0
 
 # Global obyektlar
-client = AsyncGroq(api_key=GROQ_API_KEY)
+# Qayta urinishlarni LLMGateway boshqaradi; GROQ_BASE_URL orqali lokal mock'ga ulash mumkin
+client = AsyncGroq(api_key=GROQ_API_KEY, max_retries=0)
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher()
 DB_PATH = 'slide_master.db'
+# Bazadagi egalik yozuvlari (active_jobs) uchun shu jarayon nomi
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+DB_CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', '256'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+# FSM holatlari: 'sqlite' - bazada (bir nechta jarayon uchun), 'memory' - faqat shu jarayonda
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', str(24 * 3600)))   # tashlab ketilgan holatlar
+# Yozuvlar shu oraliqda jamlanadi: boshqa jarayon holatni shuncha kech ko'rishi mumkin.
+# 0 - darhol yozish (bir nechta jarayon webhook'ni bo'lishsa tavsiya etiladi)
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.05'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+# Boshqa jarayonlar o'zgartirgan userlar (user_changes jurnali) keshdan shu oraliqda o'chiriladi; 0 - o'chirilgan
+USER_CACHE_SYNC_INTERVAL = float(os.getenv('USER_CACHE_SYNC_INTERVAL', '1'))
+# Muhim bo'lmagan yozuvlar (last_active) jamlanib, shu oraliqda yoki shuncha amal yig'ilganda yoziladi
+DB_BATCH_INTERVAL = float(os.getenv('DB_BATCH_INTERVAL', '0.5'))
+DB_BATCH_MAX_OPS = int(os.getenv('DB_BATCH_MAX_OPS', '500'))
+# Kanal obunasi keshi: ijobiy/salbiy natijalar uchun alohida TTL (soniya)
+SUB_CACHE_POSITIVE_TTL = float(os.getenv('SUB_CACHE_POSITIVE_TTL', '900'))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv('SUB_CACHE_NEGATIVE_TTL', '20'))
+SUB_CACHE_SIZE = int(os.getenv('SUB_CACHE_SIZE', '50000'))
+SUB_REFRESH_INTERVAL = float(os.getenv('SUB_REFRESH_INTERVAL', '0'))  # 0 - fon yangilash o'chirilgan
+SUB_REFRESH_WINDOW = float(os.getenv('SUB_REFRESH_WINDOW', '3600'))
+# Broadcast: Telegram limiti ~30 xabar/soniya (global) va 1 xabar/soniya (bitta chat)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '10'))
+PER_CHAT_INTERVAL = float(os.getenv('PER_CHAT_INTERVAL', '1.0'))
+# Broadcast egaligi: egasi uni lease/3 da uzaytiradi; muddati o'tsa boshqa jarayon davom ettiradi
+BROADCAST_LEASE = float(os.getenv('BROADCAST_LEASE', '60'))
+# PPTX render jarayonlar puli (0 - oddiy thread'da render qilinadi)
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE_LIMIT = int(os.getenv('RENDER_QUEUE_LIMIT', '20'))
+# Fayldan matn o'qish: alohida jarayonlar puli va cheklovlar
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', '2'))
+EXTRACT_QUEUE_LIMIT = int(os.getenv('EXTRACT_QUEUE_LIMIT', '20'))
+EXTRACT_CHAR_LIMIT = int(os.getenv('EXTRACT_CHAR_LIMIT', '15000'))
+EXTRACT_MAX_PAGES = int(os.getenv('EXTRACT_MAX_PAGES', '300'))
+EXTRACT_TIMEOUT = float(os.getenv('EXTRACT_TIMEOUT', '20'))
+# Qattiq chegara: worker shu vaqtda javob bermasa (bitta og'ir sahifa, PdfReader) to'xtatiladi
+EXTRACT_KILL_TIMEOUT = float(os.getenv('EXTRACT_KILL_TIMEOUT', str(EXTRACT_TIMEOUT + 10)))
+# Quiz fayllari: Bot API 20 MB dan katta faylni yuklab bermaydi
+QUIZ_MAX_FILE_SIZE = int(os.getenv('QUIZ_MAX_FILE_SIZE', str(20 * 1024 * 1024)))
+DOWNLOAD_SPOOL_SIZE = int(os.getenv('DOWNLOAD_SPOOL_SIZE', str(8 * 1024 * 1024)))  # undan kattasi vaqtinchalik faylga
+# Quiz: hujjat bo'laklarga bo'linib, savollar parallel tuziladi (map-reduce)
+QUIZ_QUESTION_COUNT = int(os.getenv('QUIZ_QUESTION_COUNT', '10'))
+QUIZ_DOC_CHAR_LIMIT = int(os.getenv('QUIZ_DOC_CHAR_LIMIT', '1500000'))
+QUIZ_CHUNK_TOKENS = int(os.getenv('QUIZ_CHUNK_TOKENS', '3000'))
+QUIZ_MAX_CHUNKS = int(os.getenv('QUIZ_MAX_CHUNKS', '12'))
+QUIZ_FANOUT = int(os.getenv('QUIZ_FANOUT', '4'))  # ko'pi bilan; qo'shimcha so'rovlar navbatning bo'sh slotlaridan
+CHARS_PER_TOKEN = 4  # taxminiy
+# Bir xil hujjat (file_unique_id) uchun o'qilgan matn va tayyor quiz keshi
+QUIZ_CACHE_MAX_BYTES = int(os.getenv('QUIZ_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))
+# Quiz savollari Telegram quiz poll'lari sifatida yuboriladi (0 - eski matn ko'rinishi)
+QUIZ_AS_POLLS = os.getenv('QUIZ_AS_POLLS', '1') == '1'
+QUIZ_POLL_CONCURRENCY = int(os.getenv('QUIZ_POLL_CONCURRENCY', '3'))
+# LLM javobini oqim bilan olib, slaydlarni kelishi bilan render qilish
+STREAM_GENERATION = os.getenv('STREAM_GENERATION', '1') == '1'
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '1.5'))
+LLM_MODEL = os.getenv('LLM_MODEL', "llama-3.3-70b-versatile")
+# LLM gateway: muddatlar, qayta urinishlar, hedging va zaxira model
+LLM_FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', "llama-3.1-8b-instant")
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))        # bitta urinish uchun
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', '150'))     # barcha urinishlar uchun
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '3'))
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '1.0'))
+LLM_SATURATION_LIMIT = int(os.getenv('LLM_SATURATION_LIMIT', '16'))  # asosiy modelda parallel so'rovlar
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0'))  # masalan 0.95; 0 - o'chirilgan
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+# Tayyor decklar keshi (mavzu, slayd soni, til bo'yicha)
+DECK_CACHE_ENABLED = os.getenv('DECK_CACHE_ENABLED', '1') == '1'
+DECK_CACHE_TTL = float(os.getenv('DECK_CACHE_TTL', str(7 * 24 * 3600)))
+DECK_CACHE_MAX_ENTRIES = int(os.getenv('DECK_CACHE_MAX_ENTRIES', '5000'))
+# Decklar xotiradan yuboriladi; SLIDES_ARCHIVE=1 bo'lsa nusxasi slides/ papkasida ham saqlanadi
+SLIDES_ARCHIVE = os.getenv('SLIDES_ARCHIVE', '0') == '1'
+SLIDES_RETENTION = float(os.getenv('SLIDES_RETENTION', str(24 * 3600)))
+SLIDES_JANITOR_INTERVAL = float(os.getenv('SLIDES_JANITOR_INTERVAL', '3600'))
+# Generatsiya navbati: bir vaqtda ishlaydigan LLM so'rovlari va navbat chegarasi
+GEN_MAX_CONCURRENCY = int(os.getenv('GEN_MAX_CONCURRENCY', '8'))
+GEN_QUEUE_LIMIT = int(os.getenv('GEN_QUEUE_LIMIT', '200'))
+GEN_PREMIUM_WEIGHT = int(os.getenv('GEN_PREMIUM_WEIGHT', '3'))  # har 1 oddiy userga nechta VIP
+# Userga bitta faol vazifa barcha jarayonlar bo'yicha (active_jobs jadvali). Jarayon uzilib qolsa
+# uning yozuvlari shuncha soniyadan keyin bo'shaydi; tirik jarayon ularni lease/3 da uzaytiradi
+JOB_LEASE = float(os.getenv('JOB_LEASE', '60'))
+# Band qilingan kredit muddati: shundan keyin ham 'pending' bo'lsa egasi uzilib qolgan deb qaytariladi.
+# Eng uzun vazifadan (navbat + LLM_DEADLINE + render) katta bo'lishi shart
+RESERVATION_LEASE = float(os.getenv('RESERVATION_LEASE', '3600'))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', '300'))
+QUEUE_POSITION_INTERVAL = float(os.getenv('QUEUE_POSITION_INTERVAL', '5'))
+# Webhook rejimi (WEBHOOK_MODE=1): polling o'rniga aiohttp server.
+# WEBHOOK_URL bo'sh bo'lsa webhook Telegram'da ro'yxatdan o'tkazilmaydi (lokal yuklama testi uchun)
+WEBHOOK_MODE = os.getenv('WEBHOOK_MODE', '0') == '1'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Bir nechta instansiya bir xil sirni ishlatishi uchun standart qiymat tokendan olinadi
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # Telegram tomonidan parallel so'rovlar
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '64'))       # bir vaqtda qayta ishlanadigan updatelar
+WEBHOOK_BACKLOG = int(os.getenv('WEBHOOK_BACKLOG', '1000'))     # undan ko'p bo'lsa 503 - Telegram keyinroq qayta yuboradi
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', str(1024 * 1024)))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '120'))
+# Prometheus formatidagi /metrics (faqat lokal), masalan METRICS_PORT=9108; 0 - o'chirilgan.
+# Bir xostda bir nechta jarayon bo'lsa har biriga alohida port beriladi
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# ----------------- METRIKALAR -----------------
+class Histogram:
+    """Latency gistogrammasi: belgilangan chegaralar va oxirgi qiymatlardan percentile"""
+    BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+    def __init__(self, buckets=BUCKETS, window=500):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        for i, border in enumerate(self.buckets):
+            if value <= border:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+# Tez bosqichlar (baza, parse, obuna tekshiruvi) uchun millisekundlik chegaralar
+FAST_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+STAGE_BUCKETS = {'db': FAST_BUCKETS, 'db_lock_wait': FAST_BUCKETS, 'parse': FAST_BUCKETS, 'check_sub': FAST_BUCKETS}
+
+class _StageTimer:
+    __slots__ = ('metrics', 'stage', 'started')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.metrics.inflight[self.stage] = self.metrics.inflight.get(self.stage, 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.inflight[self.stage] -= 1
+        self.metrics.observe(self.stage, time.monotonic() - self.started)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.metrics.inc('errors_total', stage=self.stage)
+        return False
+
+class Metrics:
+    """Jarayon ichidagi metrikalar: bosqichlar latency gistogrammalari, in-flight gauge'lar va hisoblagichlar"""
+    def __init__(self, prefix='slidemaster'):
+        self.prefix = prefix
+        self.latency = {}   # bosqich -> Histogram
+        self.inflight = {}  # bosqich -> hozir bajarilayotganlar soni
+        self.counters = {}  # (nomi, ((label, qiymat), ...)) -> son
+
+    def timer(self, stage):
+        """with metrics.timer('llm'): ... - vaqt, in-flight va xatolarni o'lchaydi"""
+        return _StageTimer(self, stage)
+
+    def observe(self, stage, seconds):
+        hist = self.latency.get(stage)
+        if hist is None:
+            hist = self.latency[stage] = Histogram(STAGE_BUCKETS.get(stage, Histogram.BUCKETS))
+        hist.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self):
+        return {stage: {'count': h.count, 'p50': h.percentile(0.5), 'p95': h.percentile(0.95)}
+                for stage, h in sorted(self.latency.items())}
+
+    def render(self):
+        """Prometheus text exposition formati"""
+        p = self.prefix
+        lines = [f"# TYPE {p}_stage_seconds histogram"]
+        for stage, h in sorted(self.latency.items()):
+            cumulative = 0
+            for border, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="{border}"}} {cumulative}')
+            lines.append(f'{p}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{stage}"}} {h.total:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        lines.append(f"# TYPE {p}_stage_inflight gauge")
+        for stage, value in sorted(self.inflight.items()):
+            lines.append(f'{p}_stage_inflight{{stage="{stage}"}} {value}')
+        seen = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {p}_{name} counter")
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{p}_{name}{{{label_str}}} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
 
 # --- 2. HOLATLAR (STATES) ---
 class UserStates(StatesGroup):
@@ -128,7 +455,13 @@ LANGS = {
         'send_check_now': "📸 **Endi to'lov chekini rasm sifatida yuboring:**",
         'quiz_prompt': "📂 **Faylni yuboring!**\n\nMen faylni o'qib, undagi ma'lumotlardan test (quiz) tuzib beraman.\n\n📄 Formatlar: **PDF, DOCX, TXT**",
         'quiz_processing': "⏳ **Fayl o'qilmoqda va test tuzilmoqda...**",
-        'quiz_error': "⚠️ Faylni o'qishda xatolik bo'ldi. Matnli PDF yoki Word fayl yuboring."
+        'quiz_error': "⚠️ Faylni o'qishda xatolik bo'ldi. Matnli PDF yoki Word fayl yuboring.",
+        'busy': "⏳ Hozir navbat juda band. Iltimos, birozdan keyin qayta urinib ko'ring.",
+        'progress': "🧩 **LLM {done}/{total} slayd matnini yozdi...**",
+        'btn_fresh': "🔄 Yangi variant",
+        'file_too_big': "⚠️ Fayl juda katta. Maksimal hajm: {mb} MB.",
+        'queue_pos': "🕒 **Navbatdasiz.** Sizning o'rningiz: **{pos}**",
+        'job_active': "⏳ Oldingi so'rovingiz hali bajarilmoqda. Iltimos, kuting."
     },
     'ru': {
         'welcome': "✨ **Slide Master AI Bot**\n\nИскусственный интеллект для создания профессиональных презентаций!\n\n👇 Выберите раздел из меню ниже:",
@@ -154,7 +487,13 @@ LANGS = {
         'send_check_now': "📸 **Теперь отправьте фото чека об оплате:**",
         'quiz_prompt': "📂 **Отправьте файл!**\n\nЯ прочитаю файл и создам тест (квиз) на основе информации.\n\n📄 Форматы: **PDF, DOCX, TXT**",
         'quiz_processing': "⏳ **Читаю файл и создаю тест...**",
-        'quiz_error': "⚠️ Ошибка при чтении файла. Отправьте текстовый PDF или Word."
+        'quiz_error': "⚠️ Ошибка при чтении файла. Отправьте текстовый PDF или Word.",
+        'busy': "⏳ Сейчас очередь перегружена. Пожалуйста, попробуйте чуть позже.",
+        'progress': "🧩 **LLM написал текст слайдов: {done}/{total}...**",
+        'btn_fresh': "🔄 Новый вариант",
+        'file_too_big': "⚠️ Файл слишком большой. Максимальный размер: {mb} МБ.",
+        'queue_pos': "🕒 **Вы в очереди.** Ваша позиция: **{pos}**",
+        'job_active': "⏳ Ваш предыдущий запрос ещё выполняется. Пожалуйста, подождите."
     },
     'en': {
         'welcome': "✨ **Slide Master AI Bot**\n\nProfessional presentation generator powered by AI!\n\n👇 Choose a section from the menu below:",
@@ -180,7 +519,13 @@ LANGS = {
         'send_check_now': "📸 **Now send the payment receipt as a photo:**",
         'quiz_prompt': "📂 **Send a file!**\n\nI will read the file and create a quiz based on the information.\n\n📄 Formats: **PDF, DOCX, TXT**",
         'quiz_processing': "⏳ **Reading file and generating quiz...**",
-        'quiz_error': "⚠️ Error reading file. Please send a text-based PDF or Word file."
+        'quiz_error': "⚠️ Error reading file. Please send a text-based PDF or Word file.",
+        'busy': "⏳ The queue is busy right now. Please try again in a moment.",
+        'progress': "🧩 **LLM wrote slide text {done}/{total}...**",
+        'btn_fresh': "🔄 New version",
+        'file_too_big': "⚠️ File is too large. Maximum size: {mb} MB.",
+        'queue_pos': "🕒 **You're in the queue.** Position: **{pos}**",
+        'job_active': "⏳ Your previous request is still running. Please wait."
     }
 }
 
@@ -188,13 +533,356 @@ def get_text(lang_code, key):
     """Xavfsiz matn olish funksiyasi"""
     return LANGS.get(lang_code, LANGS['uz']).get(key, LANGS['uz'].get(key, "Text not found"))
 
+# ----------------- TUGMALAR MARSHRUTI -----------------
+MENU_ACTIONS = ('tariff', 'cabinet', 'invite', 'quiz', 'lang')  # 'btns' tartibida
+PACKAGES = (("1_slide", 1), ("5_slides", 5), ("vip_premium", 999))  # 'package_btns' tartibida
+SHARE_BTN = "📤 Ulashish"
+
+def build_button_routes():
+    """Barcha tillardagi tugma matni -> (amal, argument, til). Bir necha tilda bir xil matn bo'lsa til None"""
+    routes = {}
+
+    def add(label, action, arg, lang):
+        if label in routes:
+            if routes[label][:2] != (action, arg):
+                raise ValueError(f"Tugma matni ikki xil amalga biriktirilgan: {label!r}")
+            if routes[label][2] != lang:
+                routes[label] = (action, arg, None)
+        else:
+            routes[label] = (action, arg, lang)
+
+    for lang, texts in LANGS.items():
+        for action, label in zip(MENU_ACTIONS, texts['btns']):
+            add(label, action, None, lang)
+        for package, label in zip(PACKAGES, texts['package_btns']):
+            add(label, 'package', package, lang)
+        add(texts['cancel'], 'cancel', None, lang)
+    add(SHARE_BTN, 'share', None, 'uz')
+    return MappingProxyType(routes)
+
+# Ishga tushishda bir marta quriladi, keyin o'zgarmaydi
+BUTTON_ROUTES = build_button_routes()
+NO_ROUTE = (None, None, None)
+
 # --- 4. BAZA MANAGER ---
+class TimedLock:
+    """asyncio.Lock, navbatda kutish vaqti o'lchanadi. owner - qulfni ushlab turgan vazifa"""
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.owner = None
+        self._idle_waiters = []
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        await self._lock.acquire()
+        waited = time.monotonic() - started
+        metrics.observe('db_lock_wait', waited)
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.owner = asyncio.current_task()
+
+    async def __aexit__(self, *exc):
+        self.owner = None
+        # O'quvchilar keyingi yozuvchidan oldin uyg'onadi (ularning callback'lari oldinroq navbatga qo'yiladi)
+        for fut in self._idle_waiters:
+            if not fut.done():
+                fut.set_result(None)
+        self._idle_waiters.clear()
+        self._lock.release()
+
+    async def wait_idle(self):
+        """Qulf boshqa vazifada bo'lsa, u bo'shaguncha kutadi (qulfni olmaydi)"""
+        while self._lock.locked() and self.owner is not asyncio.current_task():
+            fut = asyncio.get_running_loop().create_future()
+            self._idle_waiters.append(fut)
+            await fut
+
+    def stats(self):
+        return {
+            'acquired': self.acquired,
+            'wait_avg': self.wait_total / self.acquired if self.acquired else 0.0,
+            'wait_max': self.wait_max
+        }
+
+class WriteBatcher:
+    """Write-behind: muhim bo'lmagan yozuvlar kalit bo'yicha birlashtiriladi (oxirgisi qoladi)
+    va bitta tranzaksiyada yoziladi. Kreditga ta'sir qiladigan yozuvlar bu yerdan o'tmaydi"""
+    def __init__(self, database, interval, max_ops):
+        self.db = database
+        self.interval = interval
+        self.max_ops = max_ops
+        self._pending = {}  # key -> (sql, params)
+        self._wakeup = asyncio.Event()
+        self.ops = 0
+        self.rows = 0
+        self.batches = 0
+        self.batch_max = 0
+        self.flush_total = 0.0
+        self.flush_max = 0.0
+
+    def defer(self, key, sql, params):
+        self._pending[key] = (sql, params)
+        self.ops += 1
+        if len(self._pending) >= self.max_ops:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        grouped = {}
+        for sql, params in batch.values():
+            grouped.setdefault(sql, []).append(params)
+        started = time.monotonic()
+        try:
+            async with self.db.transaction() as conn:
+                for sql, rows in grouped.items():
+                    await conn.executemany(sql, rows)
+        except Exception:
+            # Keyingi urinishda yoziladi; shu orada kelgan yangi qiymatlar ustun
+            for key, item in batch.items():
+                self._pending.setdefault(key, item)
+            raise
+        elapsed = time.monotonic() - started
+        self.rows += len(batch)
+        self.batches += 1
+        self.batch_max = max(self.batch_max, len(batch))
+        self.flush_total += elapsed
+        self.flush_max = max(self.flush_max, elapsed)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.warning(f"Jamlangan yozuvlarni saqlashda xato: {e}")
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'ops': self.ops,
+            'rows': self.rows,
+            'batches': self.batches,
+            'batch_avg': self.rows / self.batches if self.batches else 0.0,
+            'batch_max': self.batch_max,
+            'flush_avg': self.flush_total / self.batches if self.batches else 0.0,
+            'flush_max': self.flush_max
+        }
+
+class UserCache:
+    """Foydalanuvchi qatorlari uchun chegaralangan TTL/LRU kesh"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # Har bir yozuvda oshadi - eski o'qish natijasi keshga qaytib tushmasligi uchun
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        item = self._data.get(user_id)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, row = item
+        if expires < time.monotonic():
+            del self._data[user_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(user_id)
+        self.hits += 1
+        return row
+
+    def put(self, user_id, row, generation):
+        if generation != self.generation or self.maxsize <= 0:
+            return
+        self._data[user_id] = (time.monotonic() + self.ttl, row)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        """Keshdagi qatorni joyida yangilaydi (write-through)"""
+        self.generation += 1
+        item = self._data.get(user_id)
+        if item is not None:
+            item[1].update(fields)
+
+    def invalidate(self, user_id=None):
+        self.generation += 1
+        if user_id is None:
+            self._data.clear()
+        else:
+            self._data.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+# Sxema migratsiyalari: (versiya, nomi, SQL bayonotlari). PRAGMA user_version bo'yicha
+# faqat yangilari qo'llanadi; mavjudlari o'zgartirilmaydi, yangisi ro'yxat oxiriga qo'shiladi
+MIGRATIONS = [
+    (1, "indekslar", [
+        "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments (status)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_reservations_status ON reservations (status)",
+        "CREATE INDEX IF NOT EXISTS idx_deck_cache_last_used ON deck_cache (last_used)",
+    ]),
+    (2, "referrals.referred_id yagona", [
+        # Bir user faqat bir marta taklif qilingan bo'lishi mumkin: eski takrorlar (birinchisidan tashqari) o'chiriladi
+        "DELETE FROM referrals WHERE id NOT IN (SELECT MIN(id) FROM referrals GROUP BY referred_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)",
+    ]),
+    (3, "stats qatori va triggerlar", [
+        """CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER NOT NULL DEFAULT 0,
+            premium_users INTEGER NOT NULL DEFAULT 0,
+            total_slides INTEGER NOT NULL DEFAULT 0
+        )""",
+        """INSERT OR REPLACE INTO stats (id, total_users, premium_users, total_slides)
+           SELECT 1, COUNT(*), COALESCE(SUM(is_premium = 1), 0), COALESCE(SUM(balance), 0) FROM users""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET total_users = total_users + 1,
+                             premium_users = premium_users + (NEW.is_premium = 1),
+                             total_slides = total_slides + COALESCE(NEW.balance, 0)
+            WHERE id = 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF balance, is_premium ON users BEGIN
+            UPDATE stats SET premium_users = premium_users + (NEW.is_premium = 1) - (OLD.is_premium = 1),
+                             total_slides = total_slides + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0)
+            WHERE id = 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET total_users = total_users - 1,
+                             premium_users = premium_users - (OLD.is_premium = 1),
+                             total_slides = total_slides - COALESCE(OLD.balance, 0)
+            WHERE id = 1;
+        END""",
+    ]),
+    (4, "reservations.lease_until", [
+        # Bir nechta jarayon bitta bazada: faqat muddati o'tgan band qilishlar qaytariladi
+        "ALTER TABLE reservations ADD COLUMN lease_until REAL",
+        "UPDATE reservations SET lease_until = 0 WHERE lease_until IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_reservations_lease ON reservations (status, lease_until)",
+    ]),
+    (5, "jarayonlararo kesh va vazifa qulfi", [
+        # users qatoridagi o'zgarishlar (qaysi jarayondan bo'lmasin) jurnalga tushadi, boshqa
+        # jarayonlar shu bo'yicha o'z keshlarini tozalaydi. last_active kuzatilmaydi
+        """CREATE TABLE IF NOT EXISTS user_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id BIGINT,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_changes_update
+           AFTER UPDATE OF username, first_name, last_name, lang, is_premium, balance ON users BEGIN
+            INSERT INTO user_changes (user_id) VALUES (NEW.id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_changes_delete AFTER DELETE ON users BEGIN
+            INSERT INTO user_changes (user_id) VALUES (OLD.id);
+        END""",
+        "CREATE INDEX IF NOT EXISTS idx_user_changes_at ON user_changes (changed_at)",
+        # Userning faol vazifasi: egasi (INSTANCE_ID), vazifa raqami va egalik muddati
+        """CREATE TABLE IF NOT EXISTS active_jobs (
+            user_id BIGINT PRIMARY KEY,
+            owner TEXT,
+            token INTEGER,
+            lease_until REAL
+        )""",
+    ]),
+    (6, "broadcasts egasi va muddati", [
+        # Bir nechta jarayon: 'running' broadcastni faqat egasi yuboradi, egalik muddati o'tgandagina boshqasi oladi
+        "ALTER TABLE broadcasts ADD COLUMN owner TEXT",
+        "ALTER TABLE broadcasts ADD COLUMN lease_until REAL",
+        "UPDATE broadcasts SET lease_until = 0 WHERE lease_until IS NULL",
+    ]),
+]
+
 class Database:
+    """Bitta uzoq yashovchi aiosqlite ulanishi (WAL rejimi) ustidagi baza qatlami"""
     def __init__(self, db_path):
         self.db_path = db_path
+        self.conn = None
+        # Bitta ulanishda tranzaksiyalar aralashib ketmasligi uchun yozuvlar ketma-ket
+        self._write_lock = TimedLock()
+        self.user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.batcher = WriteBatcher(self, DB_BATCH_INTERVAL, DB_BATCH_MAX_OPS)
+        self._changes_seen = 0  # user_changes jurnalining shu jarayon ko'rgan oxirgi seq'i
+
+    async def connect(self):
+        if self.conn is not None:
+            return self.conn
+        # cached_statements - sqlite3 tayyorlangan so'rovlarni keshlab qayta ishlatadi
+        self.conn = await aiosqlite.connect(self.db_path, cached_statements=DB_CACHED_STATEMENTS)
+        self.conn.row_factory = aiosqlite.Row
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        await self.conn.execute("PRAGMA busy_timeout=5000")
+        await self.conn.execute("PRAGMA temp_store=MEMORY")
+        return self.conn
+
+    async def close(self):
+        if self.conn is not None:
+            await self.batcher.flush()
+            await self.conn.close()
+            self.conn = None
+
+    async def _fetchone(self, sql, params=()):
+        rows = await self._fetchall(sql, params)
+        return rows[0] if rows else None
+
+    async def _fetchall(self, sql, params=()):
+        """Bitta ulanishda ochiq tranzaksiya bo'lsa (boshqa korutinaniki) o'qish uning tugashini kutadi -
+        aks holda commit qilinmagan (balki rollback bo'ladigan) qatorlar ko'rinadi. Kutishdan keyin
+        so'rov await'siz navbatga qo'yiladi va bitta chaqiruvda o'qiladi, orasiga yozuv tushmaydi"""
+        with metrics.timer('db'):
+            await self._write_lock.wait_idle()
+            return await self.conn.execute_fetchall(sql, params)
+
+    async def _write(self, sql, params=()):
+        async with self._write_lock:
+            with metrics.timer('db'):
+                cursor = await self.conn.execute(sql, params)
+                await self.conn.commit()
+                lastrowid = cursor.lastrowid
+                await cursor.close()
+                return lastrowid
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Yozish qulfi ostida bitta tranzaksiya: muvaffaqiyatda commit, xatoda rollback"""
+        async with self._write_lock:
+            try:
+                with metrics.timer('db'):
+                    yield self.conn
+                    await self.conn.commit()
+            except BaseException:
+                await self.conn.rollback()
+                raise
+
+    def write_lock_stats(self):
+        return self._write_lock.stats()
 
     async def init(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        db = await self.connect()
+        async with self._write_lock:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     id BIGINT PRIMARY KEY,
@@ -229,108 +917,805 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS doc_text_cache (
+                    file_unique_id TEXT PRIMARY KEY,
+                    text TEXT,
+                    size INTEGER,
+                    last_used REAL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS quiz_cache (
+                    file_unique_id TEXT,
+                    lang TEXT,
+                    quiz TEXT,
+                    size INTEGER,
+                    last_used REAL,
+                    PRIMARY KEY (file_unique_id, lang)
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    admin_id BIGINT,
+                    text TEXT,
+                    photo_id TEXT,
+                    caption TEXT,
+                    status TEXT DEFAULT 'running',
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id BIGINT,
+                    amount INTEGER,
+                    kind TEXT,
+                    ref TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS reservations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id BIGINT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS deck_cache (
+                    key TEXT PRIMARY KEY,
+                    topic TEXT,
+                    slide_count INTEGER,
+                    lang TEXT,
+                    slides_json TEXT,
+                    file_id TEXT,
+                    created_at REAL,
+                    last_used REAL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_states (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT DEFAULT '{}',
+                    updated REAL
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated)")
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                    broadcast_id INTEGER,
+                    user_id BIGINT,
+                    status TEXT,
+                    PRIMARY KEY (broadcast_id, user_id)
+                )
+            """)
             await db.commit()
+            await self.migrate()
+        # Ishga tushishdan oldingi o'zgarishlar bizga tegishli emas - kesh hali bo'sh
+        self._changes_seen = (await self._fetchone("SELECT COALESCE(MAX(seq), 0) FROM user_changes"))[0]
+
+    async def migrate(self):
+        """Yangi migratsiyalarni qo'llaydi. BEGIN IMMEDIATE - bir vaqtda ishga tushgan jarayonlar
+        bitta migratsiyani ikki marta qo'llamaydi"""
+        for version, name, statements in MIGRATIONS:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = (await self._fetchone("PRAGMA user_version"))[0]
+                if version <= current:
+                    await self.conn.rollback()
+                    continue
+                for sql in statements:
+                    await self.conn.execute(sql)
+                await self.conn.execute(f"PRAGMA user_version = {version}")
+                await self.conn.commit()
+                logger.info(f"🛠 Migratsiya {version} ({name}) qo'llandi")
+            except Exception:
+                await self.conn.rollback()
+                raise
 
     async def get_user(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-            return await cursor.fetchone()
-
-    async def add_user(self, user_id, username, first_name, last_name, referrer_id=None):
-        async with aiosqlite.connect(self.db_path) as db:
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return cached
+        generation = self.user_cache.generation
+        row = await self._fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+        if row is None:
+            return None
+        user = dict(row)
+        self.user_cache.put(user_id, user, generation)
+        return user
+
+    async def sync_user_cache(self):
+        """Boshqa jarayonlar o'zgartirgan userlarni keshdan o'chiradi (user_changes jurnali bo'yicha)"""
+        rows = await self._fetchall("SELECT seq, user_id FROM user_changes WHERE seq > ? ORDER BY seq",
+                                    (self._changes_seen,))
+        if rows:
+            self._changes_seen = rows[-1]['seq']
+            for row in rows:
+                self.user_cache.invalidate(row['user_id'])
+        return len(rows)
+
+    async def prune_user_changes(self, max_age):
+        await self._write("DELETE FROM user_changes WHERE changed_at < datetime('now', ?)",
+                          (f"-{int(max_age)} seconds",))
+
+    def touch_user(self, user_id):
+        """last_active - muhim emas, write-behind orqali yoziladi"""
+        self.batcher.defer(('last_active', user_id),
+                           "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
+
+    async def add_user(self, user_id, username, first_name, last_name, referrer_id=None, referral_bonus=0):
+        """Yangi user qo'shilsa True. Taklif bonusi (bo'lsa) shu tranzaksiyaning o'zida beriladi"""
+        if await self.get_user(user_id) is not None:
+            self.touch_user(user_id)
+            return False
+        async with self._write_lock:
             try:
-                await db.execute("""
+                await self.conn.execute("""
                     INSERT INTO users (id, username, first_name, last_name, invited_by, balance) 
                     VALUES (?, ?, ?, ?, ?, 2)
                 """, (user_id, username, first_name, last_name, referrer_id))
-                await db.commit()
-                
                 if referrer_id:
-                    await db.execute("""
-                        INSERT INTO referrals (referrer_id, referred_id) 
+                    cursor = await self.conn.execute("""
+                        INSERT OR IGNORE INTO referrals (referrer_id, referred_id) 
                         VALUES (?, ?)
                     """, (referrer_id, user_id))
-                    await db.commit()
-                return True
+                    referred = cursor.rowcount == 1
+                    await cursor.close()
+                    if referred and referral_bonus:
+                        cursor = await self.conn.execute(
+                            "UPDATE users SET balance = balance + ? WHERE id = ?", (referral_bonus, referrer_id))
+                        if cursor.rowcount == 1:
+                            await self._log_transaction(referrer_id, referral_bonus, 'referral', user_id)
+                        await cursor.close()
+                await self.conn.commit()
             except aiosqlite.IntegrityError:
-                await db.execute("UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?", (user_id,))
-                await db.commit()
+                # Parallel /start: user allaqachon qo'shilgan
+                await self.conn.rollback()
+                self.touch_user(user_id)
                 return False
-
-    async def update_balance(self, user_id, amount):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-            await db.commit()
+        self.user_cache.invalidate(user_id)
+        if referrer_id:
+            self.user_cache.invalidate(referrer_id)
+        return True
+
+    async def update_balance(self, user_id, amount, kind='adjust', ref=None):
+        async with self._write_lock:
+            await self.conn.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
+            await self._log_transaction(user_id, amount, kind, ref)
+            await self.conn.commit()
+        # Nisbiy o'zgarish - keshdagi qiymatni taxmin qilmasdan o'chiramiz
+        self.user_cache.invalidate(user_id)
+
+    async def _log_transaction(self, user_id, amount, kind, ref=None):
+        """Faqat qo'shiladigan (append-only) balans jurnali; _write_lock ichida chaqiriladi"""
+        await self.conn.execute("INSERT INTO transactions (user_id, amount, kind, ref) VALUES (?, ?, ?, ?)",
+                                (user_id, amount, kind, None if ref is None else str(ref)))
+
+    async def reserve_credit(self, user_id):
+        """Bitta shartli UPDATE bilan 1 kreditni band qiladi. Balans yetmasa None qaytaradi"""
+        async with self._write_lock:
+            cursor = await self.conn.execute(
+                "UPDATE users SET balance = balance - 1 WHERE id = ? AND balance > 0", (user_id,))
+            if cursor.rowcount != 1:
+                await cursor.close()
+                return None
+            await cursor.close()
+            cursor = await self.conn.execute("INSERT INTO reservations (user_id, lease_until) VALUES (?, ?)",
+                                             (user_id, time.time() + RESERVATION_LEASE))
+            reservation_id = cursor.lastrowid
+            await cursor.close()
+            await self._log_transaction(user_id, -1, 'reserve', reservation_id)
+            await self.conn.commit()
+        self.user_cache.invalidate(user_id)
+        return reservation_id
+
+    async def commit_reservation(self, reservation_id):
+        async with self._write_lock:
+            cursor = await self.conn.execute(
+                "UPDATE reservations SET status = 'committed' WHERE id = ? AND status = 'pending'", (reservation_id,))
+            committed = cursor.rowcount == 1
+            if committed:
+                row = await self._fetchone("SELECT user_id FROM reservations WHERE id = ?", (reservation_id,))
+                await self._log_transaction(row['user_id'], 0, 'commit', reservation_id)
+            await cursor.close()
+            await self.conn.commit()
+        if not committed:
+            logger.warning(f"⚠️ Band qilish #{reservation_id} muddati o'tib qaytarilgan edi (RESERVATION_LEASE juda qisqa?)")
+
+    async def refund_reservation(self, reservation_id):
+        async with self._write_lock:
+            cursor = await self.conn.execute(
+                "UPDATE reservations SET status = 'refunded' WHERE id = ? AND status = 'pending'", (reservation_id,))
+            refunded = cursor.rowcount == 1
+            await cursor.close()
+            if refunded:
+                row = await self._fetchone("SELECT user_id FROM reservations WHERE id = ?", (reservation_id,))
+                await self.conn.execute("UPDATE users SET balance = balance + 1 WHERE id = ?", (row['user_id'],))
+                await self._log_transaction(row['user_id'], 1, 'refund', reservation_id)
+            await self.conn.commit()
+        if refunded:
+            self.user_cache.invalidate(row['user_id'])
+
+    async def refund_expired_reservations(self):
+        """Muddati o'tgan band qilishlarni qaytaradi (uzilib qolgan jarayonlarniki).
+        Boshqa jarayonlarning ishlayotgan vazifalariga tegilmaydi"""
+        rows = await self._fetchall("SELECT id FROM reservations WHERE status = 'pending' AND lease_until < ?",
+                                    (time.time(),))
+        for row in rows:
+            await self.refund_reservation(row['id'])
+        return len(rows)
 
     async def set_premium(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("UPDATE users SET is_premium = 1 WHERE id = ?", (user_id,))
-            await db.commit()
+        await self._write("UPDATE users SET is_premium = 1 WHERE id = ?", (user_id,))
+        self.user_cache.update(user_id, is_premium=1)
 
     async def update_lang(self, user_id, lang):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("UPDATE users SET lang = ? WHERE id = ?", (lang, user_id))
-            await db.commit()
+        await self._write("UPDATE users SET lang = ? WHERE id = ?", (lang, user_id))
+        self.user_cache.update(user_id, lang=lang)
 
     async def get_referral_count(self, user_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
-            res = await cursor.fetchone()
-            return res[0] if res else 0
+        res = await self._fetchone("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,))
+        return res[0] if res else 0
 
     async def get_all_users(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT id FROM users")
-            return await cursor.fetchall()
+        return await self._fetchall("SELECT id FROM users")
 
     async def get_stats(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT COUNT(*) as total_users, SUM(balance) as total_slides FROM users")
-            stats = await cursor.fetchone()
-            cursor2 = await db.execute("SELECT COUNT(*) as premium_users FROM users WHERE is_premium = 1")
-            premium_stats = await cursor2.fetchone()
-            
-            return {
-                'total_users': stats[0] if stats else 0,
-                'total_slides': stats[1] if stats else 0,
-                'premium_users': premium_stats[0] if premium_stats else 0
-            }
+        # Triggerlar yangilab turadigan bitta qator - jadvalni skanerlash shart emas
+        stats = await self._fetchone("SELECT total_users, total_slides, premium_users FROM stats WHERE id = 1")
+        
+        return {
+            'total_users': stats[0] if stats else 0,
+            'total_slides': stats[1] if stats else 0,
+            'premium_users': stats[2] if stats else 0
+        }
 
     async def add_payment(self, user_id, amount, package_type, screenshot_id):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("""
-                INSERT INTO payments (user_id, amount, package_type, screenshot_id)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, amount, package_type, screenshot_id))
-            await db.commit()
-            return cursor.lastrowid
+        return await self._write("""
+            INSERT INTO payments (user_id, amount, package_type, screenshot_id)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, amount, package_type, screenshot_id))
+
+    async def confirm_payment(self, payment_id):
+        """To'lovni tasdiqlaydi va paketni aktivlashtiradi. Eskirgan bo'lsa None qaytaradi"""
+        async with self._write_lock:
+            cursor = await self.conn.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
+            pay = await cursor.fetchone()
+            await cursor.close()
+            if not pay or pay['status'] != 'pending':
+                return None
+            uid, amt, p_type = pay['user_id'], pay['amount'], pay['package_type']
+            await self.conn.execute("UPDATE payments SET status = 'approved' WHERE id = ?", (payment_id,))
+            if p_type == 'vip_premium': await self.conn.execute("UPDATE users SET is_premium = 1 WHERE id = ?", (uid,))
+            else:
+                await self.conn.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amt, uid))
+                await self._log_transaction(uid, amt, 'payment', payment_id)
+            await self.conn.commit()
+            self.user_cache.invalidate(uid)
+            return pay
+
+    async def reject_payment(self, payment_id):
+        await self._write("UPDATE payments SET status = 'rejected' WHERE id = ?", (payment_id,))
+
+    # --- Deck kesh ---
+    async def get_cached_deck(self, key, max_age):
+        row = await self._fetchone("SELECT * FROM deck_cache WHERE key = ? AND created_at >= ?",
+                                   (key, time.time() - max_age))
+        if row:
+            # LRU hisobi - muhim emas, write-behind orqali yoziladi
+            self.batcher.defer(('deck_used', key),
+                               "UPDATE deck_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    async def put_cached_deck(self, key, topic, slide_count, lang, slides_json, file_id):
+        now = time.time()
+        await self._write("""
+            INSERT INTO deck_cache (key, topic, slide_count, lang, slides_json, file_id, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                slides_json = excluded.slides_json, file_id = excluded.file_id,
+                created_at = excluded.created_at, last_used = excluded.last_used
+        """, (key, topic, slide_count, lang, slides_json, file_id, now, now))
+
+    async def prune_deck_cache(self, max_age, max_entries):
+        """Eskirganlarni va limitdan oshganlarni (eng kam ishlatilganidan boshlab) o'chiradi"""
+        async with self._write_lock:
+            await self.conn.execute("DELETE FROM deck_cache WHERE created_at < ?", (time.time() - max_age,))
+            await self.conn.execute("""
+                DELETE FROM deck_cache WHERE key IN (
+                    SELECT key FROM deck_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
+            await self.conn.commit()
+
+    async def count_cached_decks(self):
+        res = await self._fetchone("SELECT COUNT(*) FROM deck_cache")
+        return res[0] if res else 0
+
+    # --- Quiz kesh ---
+    async def get_cached_doc_text(self, file_unique_id):
+        row = await self._fetchone("SELECT text FROM doc_text_cache WHERE file_unique_id = ?", (file_unique_id,))
+        if row:
+            self.batcher.defer(('doc_text_used', file_unique_id),
+                               "UPDATE doc_text_cache SET last_used = ? WHERE file_unique_id = ?",
+                               (time.time(), file_unique_id))
+        return row['text'] if row else None
+
+    async def put_cached_doc_text(self, file_unique_id, text):
+        await self._write("INSERT OR REPLACE INTO doc_text_cache (file_unique_id, text, size, last_used) VALUES (?, ?, ?, ?)",
+                          (file_unique_id, text, len(text.encode('utf-8')), time.time()))
+
+    async def get_cached_quiz(self, file_unique_id, lang):
+        row = await self._fetchone("SELECT quiz FROM quiz_cache WHERE file_unique_id = ? AND lang = ?",
+                                   (file_unique_id, lang))
+        if row:
+            self.batcher.defer(('quiz_used', file_unique_id, lang),
+                               "UPDATE quiz_cache SET last_used = ? WHERE file_unique_id = ? AND lang = ?",
+                               (time.time(), file_unique_id, lang))
+        return row['quiz'] if row else None
+
+    async def put_cached_quiz(self, file_unique_id, lang, quiz):
+        await self._write("INSERT OR REPLACE INTO quiz_cache (file_unique_id, lang, quiz, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                          (file_unique_id, lang, quiz, len(quiz.encode('utf-8')), time.time()))
+
+    async def prune_quiz_cache(self, text_budget, quiz_budget):
+        """LRU: eng yangi yozuvlardan hisoblanganda hajm budjetdan oshganlarini o'chiradi"""
+        async with self._write_lock:
+            await self.conn.execute("""
+                DELETE FROM doc_text_cache WHERE file_unique_id IN (
+                    SELECT file_unique_id FROM (
+                        SELECT file_unique_id, SUM(size) OVER (ORDER BY last_used DESC) AS running
+                        FROM doc_text_cache
+                    ) WHERE running > ?
+                )
+            """, (text_budget,))
+            await self.conn.execute("""
+                DELETE FROM quiz_cache WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC) AS running
+                        FROM quiz_cache
+                    ) WHERE running > ?
+                )
+            """, (quiz_budget,))
+            await self.conn.commit()
+
+    async def quiz_cache_size(self):
+        text = await self._fetchone("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM doc_text_cache")
+        quiz = await self._fetchone("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM quiz_cache")
+        return {'docs': text[0], 'quizzes': quiz[0], 'bytes': text[1] + quiz[1]}
+
+    # --- Broadcast ---
+    async def create_broadcast(self, admin_id, text, photo_id, caption, owner, lease):
+        return await self._write("""
+            INSERT INTO broadcasts (admin_id, text, photo_id, caption, owner, lease_until)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (admin_id, text, photo_id, caption, owner, time.time() + lease))
+
+    async def claim_broadcast(self, broadcast_id, owner, lease):
+        """Egalik muddati o'tgan 'running' broadcastni egallaydi (shartli UPDATE)"""
+        now = time.time()
+        async with self.transaction() as conn:
+            cursor = await conn.execute(
+                "UPDATE broadcasts SET owner = ?, lease_until = ? WHERE id = ? AND status = 'running' AND lease_until < ?",
+                (owner, now + lease, broadcast_id, now))
+            claimed = cursor.rowcount == 1
+            await cursor.close()
+        return claimed
+
+    async def renew_broadcast(self, broadcast_id, owner, lease):
+        """False - egalik boshqa jarayonga o'tgan (yoki broadcast tugagan)"""
+        async with self.transaction() as conn:
+            cursor = await conn.execute(
+                "UPDATE broadcasts SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                (time.time() + lease, broadcast_id, owner))
+            renewed = cursor.rowcount == 1
+            await cursor.close()
+        return renewed
+
+    async def release_broadcast(self, broadcast_id, owner):
+        """To'xtatilgan broadcastni boshqa jarayonlar darhol davom ettira oladi"""
+        await self._write("UPDATE broadcasts SET lease_until = 0 WHERE id = ? AND owner = ?", (broadcast_id, owner))
+
+    async def get_broadcast(self, broadcast_id):
+        return await self._fetchone("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+
+    async def get_running_broadcasts(self):
+        return await self._fetchall("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id")
+
+    async def get_broadcast_recipients(self, broadcast_id, after_id, limit):
+        """Hali yetkazilmagan userlarni id bo'yicha sahifalab qaytaradi (keyset pagination)"""
+        rows = await self._fetchall("""
+            SELECT u.id FROM users u
+            LEFT JOIN broadcast_deliveries d ON d.broadcast_id = ? AND d.user_id = u.id
+            WHERE u.id > ? AND d.user_id IS NULL
+            ORDER BY u.id LIMIT ?
+        """, (broadcast_id, after_id, limit))
+        return [row[0] for row in rows]
+
+    async def record_deliveries(self, broadcast_id, results):
+        """results: [(user_id, status), ...] - bitta tranzaksiyada yoziladi"""
+        if not results:
+            return
+        sent = sum(1 for _, status in results if status == 'sent')
+        async with self._write_lock:
+            await self.conn.executemany(
+                "INSERT OR REPLACE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, ?)",
+                [(broadcast_id, uid, status) for uid, status in results])
+            await self.conn.execute(
+                "UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+                (sent, len(results) - sent, broadcast_id))
+            await self.conn.commit()
+
+    async def finish_broadcast(self, broadcast_id, status='done'):
+        await self._write("UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                          (status, broadcast_id))
+
+    # --- Faol vazifalar (barcha jarayonlar bo'yicha) ---
+    async def claim_job(self, user_id, owner, token, lease):
+        """Userning faol vazifasini egallaydi. Boshqa tirik jarayonda vazifasi bo'lsa False.
+        Shu jarayonning eski yozuvi (bo'shatilishi hali yozilmagan) ustidan yoziladi"""
+        now = time.time()
+        async with self.transaction() as conn:
+            cursor = await conn.execute("""
+                INSERT INTO active_jobs (user_id, owner, token, lease_until) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    owner = excluded.owner, token = excluded.token, lease_until = excluded.lease_until
+                WHERE active_jobs.owner = excluded.owner OR active_jobs.lease_until < ?
+            """, (user_id, owner, token, now + lease, now))
+            claimed = cursor.rowcount == 1
+            await cursor.close()
+        return claimed
+
+    def release_job(self, user_id, owner, token):
+        """Write-behind: token mos kelmasa (user shu orada yangi vazifa olgan) hech narsa o'chirilmaydi"""
+        self.batcher.defer(('job', user_id, token),
+                           "DELETE FROM active_jobs WHERE user_id = ? AND owner = ? AND token = ?",
+                           (user_id, owner, token))
+
+    async def renew_jobs(self, owner, claims, lease):
+        """claims: [(user_id, token), ...] - faqat shular uzaytiriladi, qolganlari muddati o'tib bo'shaydi"""
+        lease_until = time.time() + lease
+        async with self.transaction() as conn:
+            await conn.executemany(
+                "UPDATE active_jobs SET lease_until = ? WHERE user_id = ? AND owner = ? AND token = ?",
+                [(lease_until, uid, owner, token) for uid, token in claims])
+
+    # --- FSM holatlari ---
+    async def get_fsm_state(self, key):
+        return await self._fetchone("SELECT state, data, updated FROM fsm_states WHERE key = ?", (key,))
+
+    async def save_fsm_states(self, full, state_only, data_only, emptied):
+        """SQLiteStorage partiyasini bitta tranzaksiyada yozadi"""
+        async with self.transaction() as conn:
+            await conn.executemany("""
+                INSERT INTO fsm_states (key, state, data, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated = excluded.updated
+            """, full)
+            await conn.executemany("""
+                INSERT INTO fsm_states (key, state, updated) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated = excluded.updated
+            """, state_only)
+            await conn.executemany("""
+                INSERT INTO fsm_states (key, data, updated) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated = excluded.updated
+            """, data_only)
+            # state.clear() qilingan yozuvlar jadvalda qolmaydi
+            await conn.executemany("DELETE FROM fsm_states WHERE key = ?", emptied)
+
+    async def purge_fsm_states(self, before):
+        await self._write("DELETE FROM fsm_states WHERE updated < ?", (before,))
 
 db = Database(DB_PATH)
 
+class SQLiteStorage(BaseStorage):
+    """FSM holatlari SQLite'da. Yozuvlar qisqa oraliqda bitta tranzaksiyaga jamlanadi (boshqa jarayon
+    ularni shuncha kech ko'radi; flush_interval=0 - darhol yoziladi), TTL dan eski holatlar hisobga
+    olinmaydi va tozalanadi. WAL tufayli bir nechta jarayon bitta bazani ishlatadi"""
+    def __init__(self, database, ttl, flush_interval):
+        self.db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pending = {}   # key -> {'state': ..., 'data': ...} hali yozilmagan o'zgarishlar
+        self._flushing = {}  # yozilayotgan partiya (shu vaqtda o'qishlar uchun)
+        self._flush_lock = asyncio.Lock()
+        self.writes = 0
+        self.rows = 0
+        self.flushes = 0
+
+    def _stage(self, key, field, value):
+        self._pending.setdefault(self.key_builder.build(key), {})[field] = value
+        self.writes += 1
+
+    def _staged(self, k, field):
+        for layer in (self._pending, self._flushing):
+            change = layer.get(k)
+            if change and field in change:
+                return True, change[field]
+        return False, None
+
+    async def _load(self, k):
+        row = await self.db.get_fsm_state(k)
+        if not row or row['updated'] < time.time() - self.ttl:
+            return None, {}
+        return row['state'], json.loads(row['data'] or '{}')
+
+    async def set_state(self, key, state=None):
+        self._stage(key, 'state', state.state if isinstance(state, State) else state)
+        if not self.flush_interval:
+            await self.flush()
+
+    async def get_state(self, key):
+        k = self.key_builder.build(key)
+        found, state = self._staged(k, 'state')
+        if found:
+            return state
+        return (await self._load(k))[0]
+
+    async def set_data(self, key, data):
+        self._stage(key, 'data', copy.deepcopy(dict(data)))
+        if not self.flush_interval:
+            await self.flush()
+
+    async def get_data(self, key):
+        k = self.key_builder.build(key)
+        found, data = self._staged(k, 'data')
+        if found:
+            return copy.deepcopy(data)
+        return (await self._load(k))[1]
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            batch_size = len(self._flushing)
+            now = time.time()
+            full, state_only, data_only, emptied = [], [], [], []
+            for k, change in self._flushing.items():
+                data = json.dumps(change['data'], ensure_ascii=False) if 'data' in change else None
+                if 'state' in change and data is not None:
+                    full.append((k, change['state'], data, now))
+                    if change['state'] is None and not change['data']:
+                        emptied.append((k,))
+                elif data is not None:
+                    data_only.append((k, data, now))
+                else:
+                    state_only.append((k, change['state'], now))
+            try:
+                await self.db.save_fsm_states(full, state_only, data_only, emptied)
+            except Exception:
+                # Yozilmagan partiya qaytariladi, undan keyingi o'zgarishlar ustun turadi
+                for k, change in self._flushing.items():
+                    self._pending[k] = {**change, **self._pending.get(k, {})}
+                raise
+            finally:
+                self._flushing = {}
+            self.rows += batch_size
+            self.flushes += 1
+
+    async def purge(self):
+        await self.db.purge_fsm_states(time.time() - self.ttl)
+
+    async def run(self, purge_interval=600):
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval or purge_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_purge > purge_interval:
+                    last_purge = time.monotonic()
+                    await self.purge()
+            except Exception as e:
+                logger.warning(f"FSM holatlarini yozishda xato: {e}")
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self):
+        return {'pending': len(self._pending), 'writes': self.writes, 'rows': self.rows, 'flushes': self.flushes}
+
+fsm_storage = SQLiteStorage(db, FSM_STATE_TTL, FSM_FLUSH_INTERVAL) if FSM_STORAGE == 'sqlite' else MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
+
 # --- 5. FAYL O'QISH FUNKSIYALARI ---
-def extract_text_from_file(file_path):
-    ext = file_path.split('.')[-1].lower()
-    text = ""
+def iter_file_text(stream, ext, max_pages, deadline):
+    """Fayl matnini sahifa/paragraf bo'yicha dangasa (lazy) qaytaradi. stream - fayl yo'li yoki file-like obyekt"""
+    if ext == 'pdf':
+        reader = pypdf.PdfReader(stream)
+        for i, page in enumerate(reader.pages):
+            if i >= max_pages or time.monotonic() > deadline:
+                break
+            yield (page.extract_text() or '') + "\n"
+    elif ext == 'docx':
+        doc = Document(stream)
+        for para in doc.paragraphs:
+            if time.monotonic() > deadline:
+                break
+            yield para.text + "\n"
+    elif ext == 'txt':
+        f = open(stream, 'rb') if isinstance(stream, str) else stream
+        with io.TextIOWrapper(f, encoding='utf-8', errors='replace') as f:
+            while True:
+                chunk = f.read(8192)
+                if not chunk:
+                    break
+                yield chunk
+
+def extract_text_from_file(source, ext=None, limit=EXTRACT_CHAR_LIMIT, max_pages=EXTRACT_MAX_PAGES, timeout=EXTRACT_TIMEOUT):
+    """source - fayl yo'li yoki xotiradagi fayl baytlari (bytes bo'lsa ext majburiy)"""
+    if ext is None:
+        ext = source.split('.')[-1].lower()
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    parts = []
+    size = 0
+    deadline = time.monotonic() + timeout
     try:
-        if ext == 'pdf':
-            reader = pypdf.PdfReader(file_path)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        elif ext == 'docx':
-            doc = Document(file_path)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        elif ext == 'txt':
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
+        for piece in iter_file_text(stream, ext, max_pages, deadline):
+            parts.append(piece)
+            size += len(piece)
+            # Limitga yetganda qolgan sahifalar umuman o'qilmaydi
+            if size >= limit:
+                break
     except Exception as e:
         logger.error(f"Fayl o'qishda xato: {e}")
         return None
-    
+
+    text = ''.join(parts)
     # Juda uzun matn bo'lsa qisqartiramiz (AI limiti uchun)
-    return text[:15000] if text else None
+    return text[:limit] if text else None
+
+def split_text_chunks(text, max_chars):
+    """Matnni qator (sahifa/paragraf) chegaralari bo'yicha max_chars dan oshmaydigan bo'laklarga ajratadi"""
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split('\n'):
+        while len(line) > max_chars:
+            if current:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if current and size + len(line) + 1 > max_chars:
+            chunks.append('\n'.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return [c for c in chunks if c.strip()]
+
+def pick_spread(items, count):
+    """Ro'yxatdan teng oraliqda count ta element tanlaydi (hujjat boshidan oxirigacha qamrov)"""
+    if len(items) <= count:
+        return list(items)
+    step = len(items) / count
+    return [items[int(i * step)] for i in range(count)]
+
+_QUESTION_START = re.compile(r'^\s*\**\s*\d+\s*[.)]\s*', re.M)
+
+def parse_quiz_questions(text):
+    """'1. Savol? A) ... Answer: A' ko'rinishidagi raqamlangan matnni alohida savollarga ajratadi (matn bloklari)"""
+    starts = [m.start() for m in _QUESTION_START.finditer(text)]
+    questions = []
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(text)
+        body = _QUESTION_START.sub('', text[start:end], count=1).strip()
+        if body:
+            questions.append(body)
+    return questions
+
+# Telegram quiz poll limitlari
+POLL_QUESTION_MAX = 300
+POLL_OPTION_MAX = 100
+POLL_EXPLANATION_MAX = 200
+POLL_MAX_OPTIONS = 10
+
+_OPTION_LINE = re.compile(r'^\s*([A-J])\s*[).]\s*(.+)$')
+_ANSWER_LINE = re.compile(r'^\s*\**\s*(?:answer|javob|ответ)\s*\**\s*[:\-]\s*\**\s*([A-J])\b', re.I)
+
+def validate_quiz_question(item):
+    """Savolni sxema bo'yicha tekshiradi: {'question', 'options', 'correct', 'explanation'}.
+    Telegram quiz poll'iga yaroqsiz bo'lsa None qaytaradi"""
+    if not isinstance(item, dict):
+        return None
+    question, options, correct = item.get('question'), item.get('options'), item.get('correct')
+    if not isinstance(question, str) or not isinstance(options, list):
+        return None
+    question = question.strip()
+    options = [str(o).strip() for o in options]
+    if isinstance(correct, str):
+        # "B" ko'rinishidagi javob harfi
+        letter = correct.strip().upper()[:1]
+        correct = ord(letter) - ord('A') if letter.isalpha() else None
+    if not 0 < len(question) <= POLL_QUESTION_MAX or not 2 <= len(options) <= POLL_MAX_OPTIONS:
+        return None
+    if any(not o or len(o) > POLL_OPTION_MAX for o in options) or len(set(options)) != len(options):
+        return None
+    if type(correct) is not int or not 0 <= correct < len(options):
+        return None
+    explanation = item.get('explanation')
+    explanation = explanation.strip()[:POLL_EXPLANATION_MAX] if isinstance(explanation, str) else ''
+    return {'question': question, 'options': options, 'correct': correct, 'explanation': explanation}
+
+def _parse_text_question(body):
+    """Eski matn formatidagi bitta savolni sxemaga o'tkazadi"""
+    question, options, correct = [], [], None
+    for line in body.split('\n'):
+        m = _ANSWER_LINE.match(line)
+        if m:
+            correct = m.group(1)
+            continue
+        m = _OPTION_LINE.match(line)
+        if m:
+            options.append(m.group(2))
+        elif not options and line.strip():
+            question.append(line.strip())
+    return validate_quiz_question({'question': ' '.join(question), 'options': options, 'correct': correct})
+
+def parse_quiz_payload(raw):
+    """LLM javobidan tekshirilgan savollar ro'yxati.
+    Tez yo'l - to'g'ridan-to'g'ri json.loads; keyin tozalangan JSON; oxirida eski matn formati"""
+    if not raw:
+        return []
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        try:
+            data = json.loads(clean_json_string(raw))
+        except ValueError:
+            data = None
+    if data is None:
+        return [q for q in map(_parse_text_question, parse_quiz_questions(raw)) if q]
+    items = data.get('questions') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return []
+    return [q for q in map(validate_quiz_question, items) if q]
+
+def format_quiz_text(questions):
+    """Savollarni matn ko'rinishiga o'tkazadi (poll yuborib bo'lmaganda)"""
+    blocks = []
+    for i, q in enumerate(questions, 1):
+        lines = [f"{i}. {q['question']}"]
+        lines += [f"{chr(65 + j)}) {opt}" for j, opt in enumerate(q['options'])]
+        lines.append(f"Answer: {chr(65 + q['correct'])}")
+        blocks.append('\n'.join(lines))
+    return '\n\n'.join(blocks)
+
+def _question_key(question):
+    return re.sub(r'\W+', '', question['question'].casefold())
+
+def merge_quiz_questions(per_chunk, count):
+    """Takrorlarni olib tashlaydi va savollarni barcha bo'laklardan navbatma-navbat tanlaydi"""
+    seen = set()
+    pools = []
+    for idx, questions in enumerate(per_chunk):
+        unique = []
+        for q in questions:
+            key = _question_key(q)
+            if key and key not in seen:
+                seen.add(key)
+                unique.append(q)
+        random.shuffle(unique)
+        pools.append((idx, unique))
+    # Bo'laklar tasodifiy tartibda aylanadi, natija esa hujjat tartibida qaytariladi
+    random.shuffle(pools)
+    picked = []
+    while len(picked) < count and any(q for _, q in pools):
+        for idx, questions in pools:
+            if questions and len(picked) < count:
+                picked.append((idx, questions.pop()))
+    picked.sort(key=lambda item: item[0])
+    return [q for _, q in picked]
 
 # --- 6. PPTX GENERATOR ---
 def clean_json_string(text):
@@ -345,254 +1730,1329 @@ def clean_json_string(text):
         return text[start:end+1]
     return text
 
-def create_ultra_modern_pptx(topic, json_data, uid):
+# YANGI ZAMONAVIY RANG PALITRASI
+BG_COLOR = RGBColor(13, 17, 23)      # To'q kosmik ko'k
+ACCENT_NEON = RGBColor(0, 247, 255)  # Neon moviy
+ACCENT_CORAL = RGBColor(255, 95, 109) # Korall qizil
+ACCENT_LIME = RGBColor(202, 255, 112) # Yashil-limon
+TEXT_WHITE = RGBColor(245, 247, 250) # Sof oq
+TEXT_GRAY = RGBColor(170, 180, 200)  # Kulrang
+CARD_BG = RGBColor(22, 27, 34)       # Kartalar fon
+GRADIENT_START = RGBColor(30, 40, 60) # Gradient boshlanish
+GRADIENT_END = RGBColor(15, 20, 30)   # Gradient tugashi
+
+SLIDE_WIDTH = Inches(13.333)  # 16:9 keng format
+SLIDE_HEIGHT = Inches(7.5)
+
+# Statik bezaklar (fon, chiziqlar, nuqtalar, footer) bir marta quriladi va
+# har bir slaydga tayyor XML nusxa sifatida qo'yiladi
+_chrome_cache = {}
+
+def _build_slide_chrome(date_str):
+    prs = Presentation()
+    prs.slide_width = SLIDE_WIDTH
+    prs.slide_height = SLIDE_HEIGHT
+    slide = prs.slides.add_slide(prs.slide_layouts[6])
+
+    # GRADIENT FON
+    bg = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 0, 0, prs.slide_width, prs.slide_height)
+    bg.fill.gradient()
+    bg.fill.gradient_stops[0].color.rgb = GRADIENT_START
+    bg.fill.gradient_stops[1].color.rgb = GRADIENT_END
+    bg.line.fill.background()
+
+    # GEOMETRIK DEKORATSIYALAR
+    # 1. Chap tomonda diagonal chiziq - TO'G'RI USUL
+    line1 = slide.shapes.add_connector(
+        MSO_CONNECTOR.STRAIGHT, 
+        Inches(0), Inches(2), 
+        Inches(4), Inches(0)
+    )
+    line1.line.color.rgb = ACCENT_NEON
+    line1.line.width = Pt(2)
+    
+    # 2. O'ng tomonda nuqtalar
+    for i in range(5):
+        dot = slide.shapes.add_shape(MSO_SHAPE.OVAL, 
+            Inches(11 + i*0.3), Inches(0.5 + i*0.5), 
+            Inches(0.1), Inches(0.1))
+        dot.fill.solid()
+        dot.fill.fore_color.rgb = ACCENT_CORAL
+        dot.line.fill.background()
+
+    # Sarlavha ostidagi dekorativ chiziq
+    title_line = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 
+        Inches(0.5), Inches(1.3), Inches(3), Inches(0.08))
+    title_line.fill.solid()
+    title_line.fill.fore_color.rgb = ACCENT_NEON
+    title_line.line.fill.background()
+
+    # FOOTER - YANGI DIZAYN
+    footer_bg = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 
+        0, prs.slide_height - Inches(0.6), prs.slide_width, Inches(0.6))
+    footer_bg.fill.solid()
+    footer_bg.fill.fore_color.rgb = RGBColor(20, 25, 35)
+    footer_bg.line.fill.background()
+    
+    # Chap tomonda kompaniya nomi
+    company_box = slide.shapes.add_textbox(Inches(0.5), prs.slide_height - Inches(0.5), Inches(4), Inches(0.4))
+    company_p = company_box.text_frame.paragraphs[0]
+    company_p.text = "Slide Master AI"
+    company_p.font.size = Pt(12)
+    company_p.font.bold = True
+    company_p.font.color.rgb = ACCENT_NEON
+    
+    # O'rtada sanani korsatish
+    date_box = slide.shapes.add_textbox(Inches(6), prs.slide_height - Inches(0.5), Inches(2), Inches(0.4))
+    date_p = date_box.text_frame.paragraphs[0]
+    date_p.text = date_str
+    date_p.font.size = Pt(11)
+    date_p.font.color.rgb = TEXT_GRAY
+    date_p.alignment = PP_ALIGN.CENTER
+
+    return [shape._element for shape in slide.shapes]
+
+def get_slide_chrome(date_str):
+    chrome = _chrome_cache.get(date_str)
+    if chrome is None:
+        # Faqat joriy kun shabloni saqlanadi
+        _chrome_cache.clear()
+        chrome = _chrome_cache[date_str] = _build_slide_chrome(date_str)
+    return chrome
+
+def stamp_slide_chrome(slide, chrome):
+    sp_tree = slide.shapes._spTree
+    for element in chrome:
+        sp_tree.insert_element_before(copy.deepcopy(element), 'p:extLst')
+
+def new_presentation():
+    prs = Presentation()
+    prs.slide_width = SLIDE_WIDTH
+    prs.slide_height = SLIDE_HEIGHT
+    return prs
+
+def add_content_slide(prs, s_data, idx, topic, chrome):
+    """Shablon ustiga faqat dinamik qismlarni (sarlavha, kontent, stat, insight, raqam) chizadi"""
+    slide = prs.slides.add_slide(prs.slide_layouts[6])
+    stamp_slide_chrome(slide, chrome)
+
+    # SARDALHA - YANGI DIZAYN
+    title_box = slide.shapes.add_textbox(Inches(0.5), Inches(0.4), Inches(12), Inches(1.2))
+    tf = title_box.text_frame
+    tf.word_wrap = True
+    p = tf.paragraphs[0]
+    p.text = s_data.get('title', topic).upper()
+    p.font.size = Pt(36)  # Kattaroq shrift
+    p.font.bold = True
+    p.font.color.rgb = TEXT_WHITE
+    p.font.name = "Calibri"
+
+    # SUBTITLE (agar mavjud bo'lsa)
+    sub = s_data.get('subtitle', '')
+    if sub:
+        sub_box = slide.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(10), Inches(0.5))
+        sp = sub_box.text_frame.paragraphs[0]
+        sp.text = sub
+        sp.font.size = Pt(16)
+        sp.font.italic = True
+        sp.font.color.rgb = ACCENT_LIME
+
+    # ASOSIY KONTEYNER - YANGI DIZAYN
+    main_container = slide.shapes.add_shape(
+        MSO_SHAPE.ROUNDED_RECTANGLE, 
+        Inches(0.5), Inches(2.0), Inches(8.5), Inches(4.8)
+    )
+    main_container.fill.solid()
+    main_container.fill.fore_color.rgb = CARD_BG
+    main_container.line.color.rgb = ACCENT_NEON
+    main_container.line.width = Pt(1.5)
+    
+    # SOYA SOZLAMALARI (TUZATILDI)
+    main_container.shadow.inherit = False
+    main_container.shadow.blur_radius = Pt(10)
+    main_container.shadow.offset_x = Pt(2)
+    main_container.shadow.offset_y = Pt(2)
+    # KONTEYNER ICHIDAGI KONTENT
+    content_tf = main_container.text_frame
+    content_tf.word_wrap = True
+    content_tf.margin_left = Inches(0.25)
+    content_tf.margin_top = Inches(0.25)
+    content_tf.margin_right = Inches(0.25)
+    content_tf.margin_bottom = Inches(0.25)
+    
+    points = s_data.get('content', [])
+    if isinstance(points, list) and points and isinstance(points[0], str):
+        temp = []
+        for t in points: 
+            temp.append({'bold': 'Asosiy', 'text': t})
+        points = temp
+
+    for i, point in enumerate(points):
+        if i == 0: 
+            p = content_tf.paragraphs[0]
+        else: 
+            p = content_tf.add_paragraph()
+        
+        # ZAMONAVIY BULLET POINT
+        run_bullet = p.add_run()
+        run_bullet.text = "◆ "
+        run_bullet.font.color.rgb = ACCENT_CORAL
+        run_bullet.font.size = Pt(18)
+        run_bullet.font.bold = True
+
+        bold_txt = point.get('bold', '')
+        if bold_txt:
+            run_bold = p.add_run()
+            run_bold.text = f"{bold_txt}: "
+            run_bold.font.bold = True
+            run_bold.font.color.rgb = ACCENT_LIME
+            run_bold.font.size = Pt(18)
+
+        run_main = p.add_run()
+        run_main.text = point.get('text', '')
+        run_main.font.color.rgb = TEXT_WHITE
+        run_main.font.size = Pt(18)
+        p.space_after = Pt(16)
+        p.line_spacing = 1.2
+
+    # STATISTIKA BLOGI - YANGI DIZAYN
+    stat_val = s_data.get('stat', '')
+    if stat_val:
+        # Statistikani o'rab turuvchi dekorativ ramka
+        stat_decor = slide.shapes.add_shape(
+            MSO_SHAPE.ROUNDED_RECTANGLE, 
+            Inches(9.2), Inches(2.0), Inches(3.5), Inches(2.0)
+        )
+        stat_decor.fill.solid()
+        stat_decor.fill.fore_color.rgb = RGBColor(30, 35, 42)
+        stat_decor.line.color.rgb = ACCENT_CORAL
+        stat_decor.line.width = Pt(2)
+        stat_decor.line.dash_style = 2  # Chiziqli
+        
+        # Statistik qiymat
+        stat_box = slide.shapes.add_textbox(Inches(9.3), Inches(2.3), Inches(3.3), Inches(1.0))
+        stat_tf = stat_box.text_frame
+        stat_tf.vertical_anchor = MSO_ANCHOR.MIDDLE
+        p_stat = stat_tf.paragraphs[0]
+        p_stat.text = str(stat_val)
+        p_stat.font.size = Pt(42)
+        p_stat.font.bold = True
+        p_stat.font.color.rgb = ACCENT_NEON
+        p_stat.alignment = PP_ALIGN.CENTER
+        
+        # Statistik sarlavha
+        stat_label = slide.shapes.add_textbox(Inches(9.3), Inches(3.5), Inches(3.3), Inches(0.5))
+        label_p = stat_label.text_frame.paragraphs[0]
+        label_p.text = "📊 ASOSIY KO'RSATKICH"
+        label_p.font.size = Pt(11)
+        label_p.font.color.rgb = TEXT_GRAY
+        label_p.alignment = PP_ALIGN.CENTER
+
+    # INSIGHT BLOGI - YANGI DIZAYN
+    insight_val = s_data.get('insight', '')
+    if insight_val:
+        insight_bg = slide.shapes.add_shape(
+            MSO_SHAPE.ROUNDED_RECTANGLE, 
+            Inches(9.2), Inches(4.2), Inches(3.5), Inches(2.6)
+        )
+        insight_bg.fill.solid()
+        insight_bg.fill.fore_color.rgb = RGBColor(25, 30, 40)
+        insight_bg.line.color.rgb = ACCENT_LIME
+        insight_bg.line.width = Pt(1.5)
+        
+        # Insight sarlavhasi
+        insight_header = slide.shapes.add_textbox(Inches(9.3), Inches(4.3), Inches(3.3), Inches(0.4))
+        ih_p = insight_header.text_frame.paragraphs[0]
+        ih_p.text = "💡 STRATEGIK TAVSIYA"
+        ih_p.font.size = Pt(14)
+        ih_p.font.bold = True
+        ih_p.font.color.rgb = ACCENT_LIME
+        
+        # Insight matni
+        insight_text = slide.shapes.add_textbox(Inches(9.3), Inches(4.7), Inches(3.3), Inches(1.8))
+        itf = insight_text.text_frame
+        itf.word_wrap = True
+        it_p = itf.paragraphs[0]
+        it_p.text = insight_val
+        it_p.font.size = Pt(15)
+        it_p.font.italic = True
+        it_p.font.color.rgb = TEXT_WHITE
+        it_p.line_spacing = 1.3
+
+    # O'ng tomonda slayd raqami
+    slide_num_box = slide.shapes.add_textbox(Inches(11.5), prs.slide_height - Inches(0.5), Inches(1.5), Inches(0.4))
+    slide_num_p = slide_num_box.text_frame.paragraphs[0]
+    slide_num_p.text = f"SLIDE {idx + 1}"
+    slide_num_p.font.size = Pt(12)
+    slide_num_p.font.bold = True
+    slide_num_p.font.color.rgb = ACCENT_CORAL
+    slide_num_p.alignment = PP_ALIGN.RIGHT
+    return slide
+
+def presentation_filename(topic, data):
+    """Mavzudan fayl nomi. User id qo'shilmaydi: keshdagi file_id boshqa userlarga ham shu nom bilan boradi"""
+    slug = re.sub(r'\W+', '_', topic or '').strip('_')[:40] or "Presentation"
+    return f"{slug}_{hashlib.sha1(data).hexdigest()[:8]}.pptx"
+
+def save_presentation(prs, topic):
+    """Deckni xotiraga yozadi va (fayl nomi, baytlar) qaytaradi"""
+    buffer = io.BytesIO()
+    prs.save(buffer)
+    data = buffer.getvalue()
+    filename = presentation_filename(topic, data)
+    if SLIDES_ARCHIVE:
+        os.makedirs("slides", exist_ok=True)
+        with open(os.path.join("slides", filename), 'wb') as f:
+            f.write(data)
+    return filename, data
+
+def clean_slides_dir(max_age):
+    """slides/ papkasidagi eskirgan (yoki avvalgi ishdan qolib ketgan) fayllarni o'chiradi"""
+    if not os.path.isdir("slides"):
+        return 0
+    border = time.time() - max_age
+    removed = 0
+    for entry in os.scandir("slides"):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < border:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+async def commit_delivered_reservation(reservation_id, attempts=3):
+    """Yetkazilgan deck uchun band qilishni tasdiqlaydi; xato bo'lsa qayta urinadi va hech qachon xato
+    ko'tarmaydi. Baribir yozilmasa band qilish 'pending' qoladi - uni reservation_janitor hal qiladi"""
+    for attempt in range(attempts):
+        try:
+            return await db.commit_reservation(reservation_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Band qilish #{reservation_id} tasdiqlanmadi ({attempt + 1}/{attempts}): {e}")
+            if attempt + 1 < attempts:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    logger.error(f"❌ Band qilish #{reservation_id} tasdiqlanmadi, muddati o'tgach reservation_janitor hal qiladi")
+
+async def reservation_janitor(interval):
+    while True:
+        refunded = await db.refund_expired_reservations()
+        if refunded:
+            logger.info(f"↩️ {refunded} ta yakunlanmagan band qilingan kredit qaytarildi")
+        await asyncio.sleep(interval)
+
+async def user_cache_sync(interval, retention=3600):
+    """Boshqa jarayonlarda o'zgargan userlarni shu jarayon keshidan o'chiradi, eski jurnalni tozalaydi"""
+    last_prune = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await db.sync_user_cache()
+            if time.monotonic() - last_prune > retention:
+                last_prune = time.monotonic()
+                await db.prune_user_changes(retention)
+        except Exception as e:
+            logger.warning(f"User keshini sinxronlashda xato: {e}")
+
+async def slides_janitor(interval, max_age):
+    while True:
+        removed = await asyncio.to_thread(clean_slides_dir, max_age)
+        if removed:
+            logger.info(f"🧹 slides/ papkasidan {removed} ta eski fayl o'chirildi")
+        await asyncio.sleep(interval)
+
+def create_ultra_modern_pptx(topic, json_data):
     try:
-        cleaned_json = clean_json_string(json_data)
-        data = json.loads(cleaned_json)
-
-        prs = Presentation()
-        prs.slide_width = Inches(13.333)  # 16:9 keng format
-        prs.slide_height = Inches(7.5)
-
-        # YANGI ZAMONAVIY RANG PALITRASI
-        BG_COLOR = RGBColor(13, 17, 23)      # To'q kosmik ko'k
-        ACCENT_NEON = RGBColor(0, 247, 255)  # Neon moviy
-        ACCENT_CORAL = RGBColor(255, 95, 109) # Korall qizil
-        ACCENT_LIME = RGBColor(202, 255, 112) # Yashil-limon
-        TEXT_WHITE = RGBColor(245, 247, 250) # Sof oq
-        TEXT_GRAY = RGBColor(170, 180, 200)  # Kulrang
-        CARD_BG = RGBColor(22, 27, 34)       # Kartalar fon
-        GRADIENT_START = RGBColor(30, 40, 60) # Gradient boshlanish
-        GRADIENT_END = RGBColor(15, 20, 30)   # Gradient tugashi
+        # Oldindan tahlil qilingan dict ham qabul qilinadi
+        data = json_data if isinstance(json_data, dict) else json.loads(clean_json_string(json_data))
 
+        prs = new_presentation()
+        chrome = get_slide_chrome(time.strftime('%Y-%m-%d'))
         for idx, s_data in enumerate(data.get('slides', [])):
-            slide = prs.slides.add_slide(prs.slide_layouts[6])
-
-            # GRADIENT FON
-            bg = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 0, 0, prs.slide_width, prs.slide_height)
-            bg.fill.gradient()
-            bg.fill.gradient_stops[0].color.rgb = GRADIENT_START
-            bg.fill.gradient_stops[1].color.rgb = GRADIENT_END
-            bg.line.fill.background()
-
-            # GEOMETRIK DEKORATSIYALAR
-            # 1. Chap tomonda diagonal chiziq - TO'G'RI USUL
-            line1 = slide.shapes.add_connector(
-                MSO_CONNECTOR.STRAIGHT, 
-                Inches(0), Inches(2), 
-                Inches(4), Inches(0)
-            )
-            line1.line.color.rgb = ACCENT_NEON
-            line1.line.width = Pt(2)
-            
-            # 2. O'ng tomonda nuqtalar
-            for i in range(5):
-                dot = slide.shapes.add_shape(MSO_SHAPE.OVAL, 
-                    Inches(11 + i*0.3), Inches(0.5 + i*0.5), 
-                    Inches(0.1), Inches(0.1))
-                dot.fill.solid()
-                dot.fill.fore_color.rgb = ACCENT_CORAL
-                dot.line.fill.background()
-
-            # SARDALHA - YANGI DIZAYN
-            title_box = slide.shapes.add_textbox(Inches(0.5), Inches(0.4), Inches(12), Inches(1.2))
-            tf = title_box.text_frame
-            tf.word_wrap = True
-            p = tf.paragraphs[0]
-            p.text = s_data.get('title', topic).upper()
-            p.font.size = Pt(36)  # Kattaroq shrift
-            p.font.bold = True
-            p.font.color.rgb = TEXT_WHITE
-            p.font.name = "Calibri"
-            
-            # Sarlavha ostidagi dekorativ chiziq
-            title_line = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 
-                Inches(0.5), Inches(1.3), Inches(3), Inches(0.08))
-            title_line.fill.solid()
-            title_line.fill.fore_color.rgb = ACCENT_NEON
-            title_line.line.fill.background()
-
-            # SUBTITLE (agar mavjud bo'lsa)
-            sub = s_data.get('subtitle', '')
-            if sub:
-                sub_box = slide.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(10), Inches(0.5))
-                sp = sub_box.text_frame.paragraphs[0]
-                sp.text = sub
-                sp.font.size = Pt(16)
-                sp.font.italic = True
-                sp.font.color.rgb = ACCENT_LIME
-
-            # ASOSIY KONTEYNER - YANGI DIZAYN
-            main_container = slide.shapes.add_shape(
-                MSO_SHAPE.ROUNDED_RECTANGLE, 
-                Inches(0.5), Inches(2.0), Inches(8.5), Inches(4.8)
-            )
-            main_container.fill.solid()
-            main_container.fill.fore_color.rgb = CARD_BG
-            main_container.line.color.rgb = ACCENT_NEON
-            main_container.line.width = Pt(1.5)
-            
-            # SOYA SOZLAMALARI (TUZATILDI)
-            main_container.shadow.inherit = False
-            main_container.shadow.blur_radius = Pt(10)
-            main_container.shadow.offset_x = Pt(2)
-            main_container.shadow.offset_y = Pt(2)
-            # main_container.shadow.color.rgb = RGBColor(0, 0, 0)  <-- BU QATOR O'CHIRILDI
-            # KONTEYNER ICHIDAGI KONTENT
-            content_tf = main_container.text_frame
-            content_tf.word_wrap = True
-            content_tf.margin_left = Inches(0.25)
-            content_tf.margin_top = Inches(0.25)
-            content_tf.margin_right = Inches(0.25)
-            content_tf.margin_bottom = Inches(0.25)
-            
-            points = s_data.get('content', [])
-            if isinstance(points, list) and points and isinstance(points[0], str):
-                temp = []
-                for t in points: 
-                    temp.append({'bold': 'Asosiy', 'text': t})
-                points = temp
-
-            for i, point in enumerate(points):
-                if i == 0: 
-                    p = content_tf.paragraphs[0]
-                else: 
-                    p = content_tf.add_paragraph()
-                
-                # ZAMONAVIY BULLET POINT
-                run_bullet = p.add_run()
-                run_bullet.text = "◆ "
-                run_bullet.font.color.rgb = ACCENT_CORAL
-                run_bullet.font.size = Pt(18)
-                run_bullet.font.bold = True
-
-                bold_txt = point.get('bold', '')
-                if bold_txt:
-                    run_bold = p.add_run()
-                    run_bold.text = f"{bold_txt}: "
-                    run_bold.font.bold = True
-                    run_bold.font.color.rgb = ACCENT_LIME
-                    run_bold.font.size = Pt(18)
-
-                run_main = p.add_run()
-                run_main.text = point.get('text', '')
-                run_main.font.color.rgb = TEXT_WHITE
-                run_main.font.size = Pt(18)
-                p.space_after = Pt(16)
-                p.line_spacing = 1.2
-
-            # STATISTIKA BLOGI - YANGI DIZAYN
-            stat_val = s_data.get('stat', '')
-            if stat_val:
-                # Statistikani o'rab turuvchi dekorativ ramka
-                stat_decor = slide.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE, 
-                    Inches(9.2), Inches(2.0), Inches(3.5), Inches(2.0)
-                )
-                stat_decor.fill.solid()
-                stat_decor.fill.fore_color.rgb = RGBColor(30, 35, 42)
-                stat_decor.line.color.rgb = ACCENT_CORAL
-                stat_decor.line.width = Pt(2)
-                stat_decor.line.dash_style = 2  # Chiziqli
-                
-                # Statistik qiymat
-                stat_box = slide.shapes.add_textbox(Inches(9.3), Inches(2.3), Inches(3.3), Inches(1.0))
-                stat_tf = stat_box.text_frame
-                stat_tf.vertical_anchor = MSO_ANCHOR.MIDDLE
-                p_stat = stat_tf.paragraphs[0]
-                p_stat.text = str(stat_val)
-                p_stat.font.size = Pt(42)
-                p_stat.font.bold = True
-                p_stat.font.color.rgb = ACCENT_NEON
-                p_stat.alignment = PP_ALIGN.CENTER
-                
-                # Statistik sarlavha
-                stat_label = slide.shapes.add_textbox(Inches(9.3), Inches(3.5), Inches(3.3), Inches(0.5))
-                label_p = stat_label.text_frame.paragraphs[0]
-                label_p.text = "📊 ASOSIY KO'RSATKICH"
-                label_p.font.size = Pt(11)
-                label_p.font.color.rgb = TEXT_GRAY
-                label_p.alignment = PP_ALIGN.CENTER
-
-            # INSIGHT BLOGI - YANGI DIZAYN
-            insight_val = s_data.get('insight', '')
-            if insight_val:
-                insight_bg = slide.shapes.add_shape(
-                    MSO_SHAPE.ROUNDED_RECTANGLE, 
-                    Inches(9.2), Inches(4.2), Inches(3.5), Inches(2.6)
-                )
-                insight_bg.fill.solid()
-                insight_bg.fill.fore_color.rgb = RGBColor(25, 30, 40)
-                insight_bg.line.color.rgb = ACCENT_LIME
-                insight_bg.line.width = Pt(1.5)
-                
-                # Insight sarlavhasi
-                insight_header = slide.shapes.add_textbox(Inches(9.3), Inches(4.3), Inches(3.3), Inches(0.4))
-                ih_p = insight_header.text_frame.paragraphs[0]
-                ih_p.text = "💡 STRATEGIK TAVSIYA"
-                ih_p.font.size = Pt(14)
-                ih_p.font.bold = True
-                ih_p.font.color.rgb = ACCENT_LIME
-                
-                # Insight matni
-                insight_text = slide.shapes.add_textbox(Inches(9.3), Inches(4.7), Inches(3.3), Inches(1.8))
-                itf = insight_text.text_frame
-                itf.word_wrap = True
-                it_p = itf.paragraphs[0]
-                it_p.text = insight_val
-                it_p.font.size = Pt(15)
-                it_p.font.italic = True
-                it_p.font.color.rgb = TEXT_WHITE
-                it_p.line_spacing = 1.3
-
-            # FOOTER - YANGI DIZAYN
-            footer_bg = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, 
-                0, prs.slide_height - Inches(0.6), prs.slide_width, Inches(0.6))
-            footer_bg.fill.solid()
-            footer_bg.fill.fore_color.rgb = RGBColor(20, 25, 35)
-            footer_bg.line.fill.background()
-            
-            # Chap tomonda kompaniya nomi
-            company_box = slide.shapes.add_textbox(Inches(0.5), prs.slide_height - Inches(0.5), Inches(4), Inches(0.4))
-            company_p = company_box.text_frame.paragraphs[0]
-            company_p.text = "Slide Master AI"
-            company_p.font.size = Pt(12)
-            company_p.font.bold = True
-            company_p.font.color.rgb = ACCENT_NEON
-            
-            # O'rtada sanani korsatish
-            date_box = slide.shapes.add_textbox(Inches(6), prs.slide_height - Inches(0.5), Inches(2), Inches(0.4))
-            date_p = date_box.text_frame.paragraphs[0]
-            date_p.text = time.strftime('%Y-%m-%d')
-            date_p.font.size = Pt(11)
-            date_p.font.color.rgb = TEXT_GRAY
-            date_p.alignment = PP_ALIGN.CENTER
-            
-            # O'ng tomonda slayd raqami
-            slide_num_box = slide.shapes.add_textbox(Inches(11.5), prs.slide_height - Inches(0.5), Inches(1.5), Inches(0.4))
-            slide_num_p = slide_num_box.text_frame.paragraphs[0]
-            slide_num_p.text = f"SLIDE {idx + 1}"
-            slide_num_p.font.size = Pt(12)
-            slide_num_p.font.bold = True
-            slide_num_p.font.color.rgb = ACCENT_CORAL
-            slide_num_p.alignment = PP_ALIGN.RIGHT
+            add_content_slide(prs, s_data, idx, topic, chrome)
 
-        os.makedirs("slides", exist_ok=True)
-        path = f"slides/Pro_Presentation_{uid}_{int(time.time())}.pptx"
-        prs.save(path)
-        return path
+        return save_presentation(prs, topic)
 
     except Exception as e:
         logger.error(f"PPTX Generator Error: {e}", exc_info=True)
         return None
 
+class PoolQueueFull(Exception):
+    """Worker puli navbati to'lganda ko'tariladi"""
+
+def _pool_job(submitted_at, func, args):
+    started = time.time()
+    result = func(*args)
+    return result, started - submitted_at, time.time() - started
+
+def _init_pool_worker(initializer=None):
+    # Log fayli va uning navbati asosiy jarayonniki - worker yozuvlari to'g'ridan-to'g'ri stderr'ga
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(ContextFilter())
+    logging.getLogger().handlers = [handler]
+    if initializer:
+        initializer()
+
+def _warm_render_worker():
+    # python-pptx va shablon worker ichida oldindan tayyorlanadi
+    get_slide_chrome(time.strftime('%Y-%m-%d'))
+
+# Forkserver jarayoni og'ir kutubxonalarni bir marta import qiladi (thread ochmaydi);
+# worker'lar undan fork qilinadi va ai.py'ni tez import qiladi
+POOL_PRELOAD = ['aiogram', 'groq', 'aiosqlite', 'aiohttp', 'pptx', 'pypdf', 'docx']
+
+class WorkerPool:
+    """Cheklangan navbatli jarayonlar puli (PPTX render va fayl o'qish uchun)"""
+    def __init__(self, workers, queue_limit, initializer=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.initializer = initializer
+        self.executor = None
+        self._slots = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def _new_executor(self):
+        # forkserver: worker'lar thread'siz toza jarayondan fork qilinadi, shuning uchun pullarni
+        # istalgan tartibda va istalgan paytda (qayta) ishga tushirish xavfsiz
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(POOL_PRELOAD)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_pool_worker,
+            initargs=(self.initializer,)
+        )
 
-# --- 7. HANDLERLAR ---
+    def start(self):
+        if self.workers <= 0 or 'forkserver' not in multiprocessing.get_all_start_methods():
+            self.workers = 0
+            return
+        self.executor = self._new_executor()
+        self._slots = asyncio.Semaphore(self.workers)
+        # Har bir submit bo'sh worker bo'lmasa yangisini ochadi - hammasi oldindan ishga tushiriladi
+        for f in [self.executor.submit(time.sleep, 0) for _ in range(self.workers)]:
+            f.result()
+
+    def recycle(self):
+        """Osilib qolgan worker'larni to'xtatib, puldagi executor'ni yangisiga almashtiradi.
+        Eski executor'dagi boshqa vazifalar BrokenProcessPool bilan tugaydi - run() ularni yangi pulda qayta bajaradi"""
+        old, self.executor = self.executor, self._new_executor()
+        # ProcessPoolExecutor'da ishlayotgan worker'ni to'xtatish uchun ochiq API yo'q
+        for proc in list((old._processes or {}).values()):
+            proc.terminate()
+        old.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def run(self, func, *args, timeout=None):
+        """timeout - faqat bajarilish vaqti (pul navbatida kutish hisobga olinmaydi);
+        oshib ketsa worker'lar qayta ishga tushiriladi va asyncio.TimeoutError ko'tariladi.
+        Boshqa vazifa sababli almashtirilgan puldagi vazifa yangi pulda bir marta qayta bajariladi"""
+        if self.pending >= max(self.workers, 1) + self.queue_limit:
+            self.rejected += 1
+            raise PoolQueueFull()
+        self.pending += 1
+        try:
+            submitted = time.time()
+            if self.executor is not None:
+                # Executor'ga faqat bo'sh worker bo'lganda beriladi - timeout navbatni o'lchamaydi
+                for attempt in (1, 2):
+                    async with self._slots:
+                        executor = self.executor
+                        future = asyncio.get_running_loop().run_in_executor(executor, _pool_job, submitted, func, args)
+                        try:
+                            result, wait, elapsed = await asyncio.wait_for(future, timeout)
+                            break
+                        except asyncio.TimeoutError:
+                            self.timeouts += 1
+                            if self.executor is executor:
+                                self.recycle()
+                            raise
+                        except BrokenProcessPool:
+                            if self.executor is executor:
+                                # Worker'ni shu vazifa (masalan, buzilgan fayl) yiqitgan - pul tiklanadi, xato o'ziniki
+                                self.recycle()
+                                raise
+                            # Pul boshqa vazifaning muddati o'tgani uchun almashtirilgan - bu vazifa aybsiz
+                            if attempt == 2:
+                                raise
+                            self.retried += 1
+            else:
+                # Thread'ni to'xtatib bo'lmaydi - faqat kutish to'xtatiladi
+                result, wait, elapsed = await asyncio.wait_for(
+                    asyncio.to_thread(_pool_job, submitted, func, args), timeout)
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.run_total += elapsed
+        self.run_max = max(self.run_max, elapsed)
+        return result
+
+    def stats(self):
+        n = self.completed or 1
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'retried': self.retried,
+            'wait_avg': self.wait_total / n,
+            'wait_max': self.wait_max,
+            'run_avg': self.run_total / n,
+            'run_max': self.run_max
+        }
+
+render_pool = WorkerPool(RENDER_WORKERS, RENDER_QUEUE_LIMIT, _warm_render_worker)
+extract_pool = WorkerPool(EXTRACT_WORKERS, EXTRACT_QUEUE_LIMIT)
+
+class SlideStreamParser:
+    """Oqim bilan kelayotgan JSON'dan har bir to'liq slides[i] obyektini yopilishi bilan ajratadi"""
+    _SLIDES_RE = re.compile(r'"slides"\s*:\s*\[')
+
+    def __init__(self):
+        self.state = 'seek'   # seek -> array -> object -> array ... -> done
+        self._prefix = ''
+        self._buf = []
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+
+    def feed(self, chunk):
+        ready = []
+        if self.state == 'seek':
+            self._prefix += chunk
+            m = self._SLIDES_RE.search(self._prefix)
+            if not m:
+                # Kalit ikki bo'lakka bo'linib kelishi mumkin - oxirini saqlaymiz
+                self._prefix = self._prefix[-64:]
+                return ready
+            chunk = self._prefix[m.end():]
+            self._prefix = ''
+            self.state = 'array'
+        for ch in chunk:
+            if self.state == 'array':
+                if ch == '{':
+                    self.state = 'object'
+                    self._depth = 1
+                    self._buf = ['{']
+                elif ch == ']':
+                    self.state = 'done'
+                continue
+            if self.state != 'object':
+                break
+            self._buf.append(ch)
+            if self._in_str:
+                if self._escape: self._escape = False
+                elif ch == '\\': self._escape = True
+                elif ch == '"': self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        ready.append(json.loads(''.join(self._buf)))
+                    except ValueError:
+                        logger.warning("Oqimdagi slayd JSON'i buzilgan, o'tkazib yuborildi")
+                    self._buf = []
+                    self.state = 'array'
+        return ready
+
+async def generate_deck_blocking(messages, topic):
+    """((fayl nomi, baytlar), slaydlar JSON'i) qaytaradi"""
+    comp = await llm.create(messages=messages, response_format={"type":"json_object"})
+    raw = comp.choices[0].message.content
+    return await render_deck(topic, raw), raw
+
+async def render_deck(topic, raw):
+    """JSON shu jarayonda tahlil qilinadi (parse), render esa worker pulida"""
+    try:
+        with metrics.timer('parse'):
+            data = json.loads(clean_json_string(raw))
+    except ValueError as e:
+        logger.error(f"PPTX Generator Error: JSON xato: {e}")
+        return None
+    with metrics.timer('render'):
+        return await render_pool.run(create_ultra_modern_pptx, topic, data)
+
+async def generate_deck_streaming(messages, topic, on_progress=None):
+    """LLM oqimini o'qiydi va oqimdan olingan (matni yozilgan) slaydlar soni bo'yicha progress ko'rsatadi.
+    Oqim davomida faqat parse qilinadi; deck oqim tugagandan keyin worker pulida bir marta render qilinadi"""
+    parser = SlideStreamParser()
+    slides = []
+    parts = []
+    last_edit = 0.0
+    # Oqimda parse vaqti yig'iladi, qolgani LLM'ni kutish
+    started = time.monotonic()
+    parse_time = 0.0
+    try:
+        try:
+            stream = await llm.create(messages=messages, response_format={"type":"json_object"}, stream=True)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                t0 = time.monotonic()
+                ready = parser.feed(delta)
+                parse_time += time.monotonic() - t0
+                slides.extend(ready)
+                if ready and on_progress and time.monotonic() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                    last_edit = time.monotonic()
+                    await on_progress(len(slides))
+        except Exception:
+            metrics.inc('errors_total', stage='llm')
+            raise
+        finally:
+            # Xato va muddat tugashida ham yoziladi - aks holda gistogramma faqat muvaffaqiyatli oqimlarni ko'rsatadi
+            metrics.observe('llm', time.monotonic() - started - parse_time)
+            metrics.observe('parse', parse_time)
+    except LLMDeadlineExceeded:
+        raise
+    except Exception as e:
+        if slides or parts:
+            raise
+        # Oqim ishlamasa (masalan, JSON rejimida stream qo'llanmasa) oddiy so'rovga qaytamiz
+        logger.warning(f"Stream generatsiya ishlamadi, oddiy rejimga o'tildi: {e}")
+        return await generate_deck_blocking(messages, topic)
+
+    if not slides:
+        # Javob kutilgan tuzilmada kelmadi - to'liq matnni odatiy yo'l bilan tahlil qilamiz
+        raw = ''.join(parts)
+        return await render_deck(topic, raw), raw
+    if on_progress:
+        await on_progress(len(slides))
+    with metrics.timer('render'):
+        deck = await render_pool.run(create_ultra_modern_pptx, topic, {'slides': slides})
+    return deck, json.dumps({'slides': slides}, ensure_ascii=False)
+
+class DeckCache:
+    """(mavzu, slayd soni, til) bo'yicha slaydlar JSON'i va Telegram file_id keshi"""
+    def __init__(self, database, max_age, max_entries):
+        self.db = database
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.file_hits = 0
+        self.json_hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    @staticmethod
+    def normalize_topic(topic):
+        topic = unicodedata.normalize('NFKC', topic or '').casefold()
+        topic = re.sub(r'\s+', ' ', topic)
+        return topic.strip(' .,!?;:"\'«»')
+
+    def key(self, topic, cnt, lang):
+        raw = f"{self.normalize_topic(topic)}|{cnt}|{lang}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def get(self, key):
+        row = await self.db.get_cached_deck(key, self.max_age)
+        if row is None:
+            self.misses += 1
+        return row
+
+    async def put(self, key, topic, cnt, lang, slides_json, file_id):
+        await self.db.put_cached_deck(key, topic, int(cnt), lang, slides_json, file_id)
+        self._puts += 1
+        if self._puts % 100 == 1:
+            await self.db.prune_deck_cache(self.max_age, self.max_entries)
+
+    async def stats(self):
+        total = self.file_hits + self.json_hits + self.misses
+        hits = self.file_hits + self.json_hits
+        return {
+            'size': await self.db.count_cached_decks(),
+            'file_hits': self.file_hits,
+            'json_hits': self.json_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else 0.0
+        }
+
+deck_cache = DeckCache(db, DECK_CACHE_TTL, DECK_CACHE_MAX_ENTRIES)
+
+
+# --- 7. LLM GATEWAY ---
+RETRYABLE_LLM_ERRORS = (groq.RateLimitError, groq.InternalServerError, groq.APIConnectionError,
+                        groq.APITimeoutError, asyncio.TimeoutError)
+
+class LLMDeadlineExceeded(Exception):
+    """LLM oqimi umumiy muddat ichida tugamadi"""
+
+class DeadlineStream:
+    """LLM oqimi ustidan: har bir bo'lak umumiy muddatning qolgan qismi ichida kelishi kerak,
+    aks holda oqim yopiladi (sekin tomchilayotgan oqim slot va kreditni cheksiz ushlab turmaydi)"""
+    def __init__(self, stream, end):
+        self.stream = stream
+        self.end = end
+        self._it = stream.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        remaining = self.end - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            return await asyncio.wait_for(self._it.__anext__(), remaining)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise LLMDeadlineExceeded("LLM oqimi muddat ichida tugamadi")
+
+    async def close(self):
+        close = getattr(self.stream, 'close', None) or getattr(self.stream, 'aclose', None)
+        if close:
+            try:
+                await close()
+            except Exception as e:
+                logger.warning(f"LLM oqimini yopishda xato: {e}")
+
+class LLMGateway:
+    """AsyncGroq ustidan: muddatlar, jitter'li eksponensial backoff (retry-after'ni hisobga oladi),
+    ixtiyoriy hedging va asosiy model band bo'lganda zaxira modelga o'tish"""
+    def __init__(self, client, model, fallback_model=None):
+        self.client = client
+        self.model = model
+        self.fallback_model = fallback_model
+        self.inflight = {}
+        self.cooldown_until = {}
+        self.latency = {}
+        self.errors = {}
+        self.hedges = 0
+        self.fallbacks = 0
+
+    def _saturated(self, model):
+        return (self.inflight.get(model, 0) >= LLM_SATURATION_LIMIT
+                or self.cooldown_until.get(model, 0.0) > time.monotonic())
+
+    def _pick_model(self, model):
+        if self.fallback_model and model == self.model and self._saturated(model):
+            self.fallbacks += 1
+            return self.fallback_model
+        return model
+
+    @staticmethod
+    def _retry_after(e):
+        response = getattr(e, 'response', None)
+        value = response.headers.get('retry-after') if response is not None else None
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
 
-async def check_sub(user_id):
+    async def _call(self, model, timeout, kwargs):
+        self.inflight[model] = self.inflight.get(model, 0) + 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                self.client.chat.completions.create(model=model, **kwargs), timeout)
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self.errors[model] = self.errors.get(model, 0) + 1
+            raise
+        finally:
+            self.inflight[model] -= 1
+        self.latency.setdefault(model, Histogram()).observe(time.monotonic() - started)
+        return result
+
+    async def _hedged_call(self, model, timeout, kwargs):
+        hist = self.latency.get(model)
+        if (LLM_HEDGE_PERCENTILE <= 0 or kwargs.get('stream')
+                or hist is None or hist.count < LLM_HEDGE_MIN_SAMPLES):
+            return await self._call(model, timeout, kwargs)
+        delay = hist.percentile(LLM_HEDGE_PERCENTILE)
+        first = asyncio.ensure_future(self._call(model, timeout, kwargs))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        # Sekin javob - xuddi shu so'rovning nusxasini yuboramiz, qaysi biri oldin kelsa o'sha olinadi
+        self.hedges += 1
+        second = asyncio.ensure_future(self._call(model, max(timeout - delay, 1.0), kwargs))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception():
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create(self, model=None, deadline=LLM_DEADLINE, **kwargs):
+        """client.chat.completions.create bilan bir xil javob (stream=True bo'lsa - oqim)"""
+        if kwargs.get('stream'):
+            # Oqimning to'liq vaqti uni o'qiydigan joyda o'lchanadi; muddat oqimni o'qishni ham qamraydi
+            end = time.monotonic() + deadline
+            return DeadlineStream(await self._create(model, deadline, kwargs), end)
+        with metrics.timer('llm'):
+            return await self._create(model, deadline, kwargs)
+
+    async def _create(self, model, deadline, kwargs):
+        model = self._pick_model(model or self.model)
+        end = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            remaining = end - time.monotonic()
+            try:
+                return await self._hedged_call(model, min(LLM_TIMEOUT, max(remaining, 0.1)), kwargs)
+            except RETRYABLE_LLM_ERRORS as e:
+                retry_after = self._retry_after(e)
+                if isinstance(e, groq.RateLimitError):
+                    self.cooldown_until[model] = time.monotonic() + (retry_after or LLM_BACKOFF_BASE)
+                delay = retry_after if retry_after is not None else LLM_BACKOFF_BASE * (2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                if attempt > LLM_MAX_RETRIES or time.monotonic() + delay >= end:
+                    if self.fallback_model and model != self.fallback_model and end - time.monotonic() > 1:
+                        logger.warning(f"LLM {model} ishlamadi ({type(e).__name__}), zaxira modelga o'tildi")
+                        self.fallbacks += 1
+                        model = self.fallback_model
+                        attempt = 0
+                        continue
+                    raise
+                logger.warning(f"LLM {model} xato ({type(e).__name__}), {delay:.1f}s dan keyin qayta uriniladi")
+                await asyncio.sleep(delay)
+                # Kutish vaqtida asosiy model bo'shagan bo'lishi mumkin
+                if model == self.model:
+                    model = self._pick_model(model)
+
+    def stats(self):
+        result = {}
+        for model in set(self.latency) | set(self.errors):
+            hist = self.latency.get(model) or Histogram()
+            result[model] = {
+                'count': hist.count,
+                'p50': hist.percentile(0.5),
+                'p95': hist.percentile(0.95),
+                'errors': self.errors.get(model, 0),
+                'inflight': self.inflight.get(model, 0)
+            }
+        return result
+
+llm = LLMGateway(client, LLM_MODEL, LLM_FALLBACK_MODEL)
+
+
+# --- 8. BROADCAST DVIGATELI ---
+class RateLimiter:
+    """Token-bucket: umumiy tezlik limiti va har bir chat uchun minimal interval"""
+    def __init__(self, rate, per_chat_interval, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.per_chat_interval = per_chat_interval
+        self._chat_next = {}
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """RetryAfter kelganda barcha yuborishlarni to'xtatib turadi"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _wait_chat(self, chat_id):
+        now = time.monotonic()
+        next_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_at) + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None and self.per_chat_interval > 0:
+            await self._wait_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+send_limiter = RateLimiter(BROADCAST_RATE, PER_CHAT_INTERVAL)
+broadcast_tasks = {}
+
+class BroadcastLeaseLost(Exception):
+    """Broadcast egaligi uzaytirilmadi - boshqa jarayon davom ettirishi mumkin, bu jarayon to'xtaydi"""
+
+async def deliver_broadcast(b, user_id, attempts=3):
+    for _ in range(attempts):
+        await send_limiter.acquire(user_id)
+        try:
+            if b['text']: await bot.send_message(user_id, b['text'], parse_mode="Markdown")
+            elif b['photo_id']: await bot.send_photo(user_id, b['photo_id'], caption=b['caption'])
+            return 'sent'
+        except TelegramRetryAfter as e:
+            send_limiter.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramNotFound):
+            return 'blocked'
+        except Exception as e:
+            logger.warning(f"Broadcast {b['id']} -> {user_id}: {e}")
+            return 'failed'
+    return 'failed'
+
+async def run_broadcast(broadcast_id, progress_msg=None):
+    """Userlarni sahifalab o'qib, cheklangan parallellik bilan yuboradi. Uzilsa davom ettiriladi.
+    Broadcast egasi shu jarayon bo'lishi kerak (create_broadcast yoki claim_broadcast)"""
+    bind_log_context(broadcast=broadcast_id)
+    b = await db.get_broadcast(broadcast_id)
+    started = time.monotonic()
+    base_sent, base_failed = b['sent'], b['failed']
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+    results = []
+    done = {'sent': 0, 'failed': 0}
+    # Egalik faqat shu vaqtgacha ishonchli: uzaytirish ketma-ket muvaffaqiyatsiz bo'lsa, boshqa jarayon
+    # bazadagi muddat o'tib uni olishidan oldin yuborish to'xtaydi
+    lease = {'valid_until': time.monotonic() + BROADCAST_LEASE * 2 / 3, 'lost': False}
+
+    async def producer():
+        after_id = 0
+        while True:
+            page = await db.get_broadcast_recipients(broadcast_id, after_id, BROADCAST_PAGE_SIZE)
+            if not page:
+                break
+            for uid in page:
+                await queue.put(uid)
+            after_id = page[-1]
+        for _ in range(BROADCAST_CONCURRENCY):
+            await queue.put(None)
+
+    async def flush():
+        batch = results[:]
+        results.clear()
+        await db.record_deliveries(broadcast_id, batch)
+
+    async def worker():
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            if lease['lost'] or time.monotonic() > lease['valid_until']:
+                raise BroadcastLeaseLost()
+            status = await deliver_broadcast(b, uid)
+            done['sent' if status == 'sent' else 'failed'] += 1
+            results.append((uid, status))
+            if len(results) >= 100:
+                await flush()
+
+    def progress_text(finished=False, error=None):
+        elapsed = max(time.monotonic() - started, 0.001)
+        rate = (done['sent'] + done['failed']) / elapsed
+        head = f"❌ Broadcast to'xtadi: {error}" if error else "✅ Broadcast tugadi" if finished else "⏳ Broadcast davom etmoqda"
+        return (f"{head} (#{broadcast_id})\n📨 Yuborildi: {base_sent + done['sent']}\n"
+                f"⚠️ Xato/bloklangan: {base_failed + done['failed']}\n⚡ Tezlik: {rate:.1f} xabar/s")
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            if progress_msg:
+                try: await progress_msg.edit_text(progress_text(), parse_mode=None)
+                except Exception: pass
+
+    async def lease_keeper():
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE / 3)
+            renewing = time.monotonic()
+            try:
+                if not await db.renew_broadcast(broadcast_id, INSTANCE_ID, BROADCAST_LEASE):
+                    lease['lost'] = True
+                    return
+                lease['valid_until'] = renewing + BROADCAST_LEASE * 2 / 3
+            except Exception as e:
+                logger.warning(f"Broadcast #{broadcast_id} egaligini uzaytirishda xato: {e}")
+
+    async def report_final(text):
+        try:
+            if progress_msg: await progress_msg.edit_text(text, parse_mode=None)
+            else: await bot.send_message(b['admin_id'], text, parse_mode=None)
+        except Exception: pass
+
+    report_task = asyncio.create_task(reporter())
+    lease_task = asyncio.create_task(lease_keeper())
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        await asyncio.gather(*tasks)
+        await flush()
+        await db.finish_broadcast(broadcast_id)
+        text = progress_text(finished=True)
+        logger.info(text.replace("\n", " | "))
+        await report_final(text)
+    except asyncio.CancelledError:
+        # Yuborilganlar yozib qo'yiladi va egalik bo'shatiladi - boshqa jarayon yoki qayta ishga tushgan bot davom etadi
+        await flush()
+        try: await db.release_broadcast(broadcast_id, INSTANCE_ID)
+        except Exception: pass
+        raise
+    except BroadcastLeaseLost:
+        # Holat o'zgartirilmaydi: broadcast 'running' qoladi va uni yangi egasi yakunlaydi
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.warning(f"⚠️ Broadcast #{broadcast_id} egaligi yo'qotildi, bu jarayonda to'xtatildi")
+        try: await flush()
+        except Exception as e: logger.error(f"Broadcast #{broadcast_id} natijalarini yozib bo'lmadi: {e}")
+    except Exception as e:
+        # Producer yoki worker yiqildi: qolganlari to'xtatiladi, aks holda queue.get() da abadiy kutishadi
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.error(f"❌ Broadcast #{broadcast_id} xato bilan to'xtadi: {e}", exc_info=True)
+        try:
+            await flush()
+            await db.finish_broadcast(broadcast_id, 'failed')
+        except Exception as db_error:
+            logger.error(f"Broadcast #{broadcast_id} holatini yozib bo'lmadi: {db_error}")
+        await report_final(progress_text(error=e))
+    finally:
+        for task in tasks:
+            task.cancel()
+        report_task.cancel()
+        lease_task.cancel()
+        broadcast_tasks.pop(broadcast_id, None)
+
+def start_broadcast_task(broadcast_id, progress_msg=None):
+    task = asyncio.create_task(run_broadcast(broadcast_id, progress_msg))
+    broadcast_tasks[broadcast_id] = task
+    return task
+
+async def resume_broadcasts():
+    """Egalik muddati o'tgan (egasi to'xtagan yoki uzilib qolgan) broadcastlarni egallab davom ettiradi"""
+    for b in await db.get_running_broadcasts():
+        if b['id'] in broadcast_tasks:
+            continue
+        if not await db.claim_broadcast(b['id'], INSTANCE_ID, BROADCAST_LEASE):
+            continue
+        logger.info(f"🔁 Broadcast #{b['id']} davom ettirilmoqda")
+        start_broadcast_task(b['id'])
+
+async def broadcast_janitor(interval):
+    while True:
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.warning(f"Broadcastlarni tekshirishda xato: {e}")
+        await asyncio.sleep(interval)
+
+
+# --- 9. NAVBAT (JOB SCHEDULER) ---
+class JobRejected(Exception):
+    """reason: 'duplicate' (userning faol vazifasi bor) yoki 'queue_full'"""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class JobScheduler:
+    """Generatsiya vazifalari navbati: userga bitta faol vazifa, umumiy parallellik chegarasi.
+    Har bir user navbatda ko'pi bilan bitta vazifaga ega, shuning uchun FIFO userlar bo'yicha
+    round-robin bilan bir xil; VIP navbati GEN_PREMIUM_WEIGHT:1 nisbatda oldinroq olinadi.
+    database berilsa "bitta faol vazifa" barcha jarayonlar bo'yicha (active_jobs) tekshiriladi;
+    parallellik va navbat chegaralari esa har bir jarayonniki."""
+    def __init__(self, max_concurrency, max_queue, premium_weight, database=None, owner=None, lease=0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.premium_weight = premium_weight
+        self.db = database
+        self.owner = owner
+        self.lease = lease
+        self.running = 0
+        self.active = set()
+        self._claims = {}  # user_id -> bazadagi active_jobs yozuvining tokeni
+        self.premium = deque()
+        self.regular = deque()
+        self._premium_streak = 0
+        self._seq = 0
+        self.completed = 0
+        self.rejected = {'duplicate': 0, 'queue_full': 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def queue_length(self):
+        return len(self.premium) + len(self.regular)
+
+    def _position(self, entry, is_premium):
+        if is_premium:
+            return self.premium.index(entry) + 1
+        i = self.regular.index(entry) + 1
+        return i + min(len(self.premium), i * self.premium_weight)
+
+    def _next(self):
+        if self.premium and (not self.regular or self._premium_streak < self.premium_weight):
+            self._premium_streak += 1
+            return self.premium.popleft()
+        self._premium_streak = 0
+        return self.regular.popleft()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrency and self.queue_length():
+            entry = self._next()
+            if entry[1].done():
+                continue
+            self.running += 1
+            entry[1].set_result(True)
+
+    def _record_wait(self, waited):
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    async def _claim(self, user_id):
+        if self.db is None:
+            return
+        token = self._seq
+        if not await self.db.claim_job(user_id, self.owner, token, self.lease):
+            self.rejected['duplicate'] += 1
+            raise JobRejected('duplicate')
+        self._claims[user_id] = token
+
+    def _forget(self, user_id):
+        self.active.discard(user_id)
+        token = self._claims.pop(user_id, None)
+        if token is not None:
+            self.db.release_job(user_id, self.owner, token)
+
+    async def acquire(self, user_id, is_premium=False, on_position=None):
+        """Slot berilguncha kutadi; on_position(pos) navbatdagi o'rin o'zgarganda chaqiriladi"""
+        self._seq += 1
+        bind_log_context(job=self._seq)
+        if user_id in self.active:
+            self.rejected['duplicate'] += 1
+            raise JobRejected('duplicate')
+        # Baza javobini kutish paytida shu jarayonda ikkinchi so'rov o'tib ketmasligi uchun oldinroq
+        self.active.add(user_id)
+        try:
+            await self._claim(user_id)
+        except BaseException:
+            self.active.discard(user_id)
+            raise
+        if self.running < self.max_concurrency and not self.queue_length():
+            self.running += 1
+            self._record_wait(0.0)
+            return
+        if self.queue_length() >= self.max_queue:
+            self._forget(user_id)
+            self.rejected['queue_full'] += 1
+            raise JobRejected('queue_full')
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (user_id, fut)
+        queue = self.premium if is_premium else self.regular
+        queue.append(entry)
+        started = time.monotonic()
+        try:
+            last_pos = None
+            while not fut.done():
+                pos = self._position(entry, is_premium)
+                if on_position and pos != last_pos:
+                    last_pos = pos
+                    await on_position(pos)
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), QUEUE_POSITION_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if fut.done():
+                # Slot berilgan edi - boshqalarga qaytaramiz
+                self.release(user_id)
+            else:
+                fut.cancel()
+                queue.remove(entry)
+                self._forget(user_id)
+            raise
+        self._record_wait(time.monotonic() - started)
+
+    def release(self, user_id):
+        self._forget(user_id)
+        self.running -= 1
+        self.completed += 1
+        self._dispatch()
+
+    def try_acquire_extra(self):
+        """Vazifa ichidagi qo'shimcha parallel LLM so'rovi uchun slot: faqat bo'sh slot bo'lsa va
+        navbatda hech kim kutmayotgan bo'lsa beriladi (kutmaydi)"""
+        if self.running < self.max_concurrency and not self.queue_length():
+            self.running += 1
+            return True
+        return False
+
+    def release_extra(self):
+        self.running -= 1
+        self._dispatch()
+
+    async def heartbeat(self):
+        """Faol vazifalar egaligini uzaytiradi; uzilib qolgan jarayonning yozuvlari muddati o'tib bo'shaydi"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not self._claims:
+                continue
+            try:
+                await self.db.renew_jobs(self.owner, list(self._claims.items()), self.lease)
+            except Exception as e:
+                logger.warning(f"Vazifa egaligini uzaytirishda xato: {e}")
+
+    def stats(self):
+        n = self.completed + self.running or 1
+        return {
+            'running': self.running,
+            'queued': self.queue_length(),
+            'completed': self.completed,
+            'rejected_duplicate': self.rejected['duplicate'],
+            'rejected_full': self.rejected['queue_full'],
+            'wait_avg': self.wait_total / n,
+            'wait_max': self.wait_max
+        }
+
+job_scheduler = JobScheduler(GEN_MAX_CONCURRENCY, GEN_QUEUE_LIMIT, GEN_PREMIUM_WEIGHT,
+                             db if JOB_LEASE > 0 else None, INSTANCE_ID, JOB_LEASE)
+
+def queue_position_notifier(msg, lang):
+    async def notify(pos):
+        try: await msg.edit_text(get_text(lang, 'queue_pos').format(pos=pos))
+        except Exception: pass
+    return notify
+
+
+# --- 10. HANDLERLAR ---
+async def log_context_middleware(handler, event, data):
+    """Har bir update uchun loglarga update va user id'larini bog'laydi"""
+    user = data.get('event_from_user')
+    token = log_context.set({'update': event.update_id, 'user': user.id if user else None})
     try:
+        return await handler(event, data)
+    finally:
+        log_context.reset(token)
+
+dp.update.outer_middleware(log_context_middleware)
+
+async def handler_metrics(handler, event, data):
+    """Har bir handler uchun updatelar, xatolar va bajarilish vaqti"""
+    name = data['handler'].callback.__name__
+    metrics.inc('updates_total', handler=name)
+    # Xatolar errors_total{stage="handler:..."} da hisoblanadi
+    with metrics.timer(f"handler:{name}"):
+        return await handler(event, data)
+
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+class SubscriptionCache:
+    """Kanal obunasi holati keshi: alohida TTL, single-flight va faol userlarni fon yangilash"""
+    def __init__(self, positive_ttl, negative_ttl, maxsize):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()      # user_id -> (expires, status)
+        self._active = OrderedDict()    # user_id -> oxirgi tekshiruv vaqti
+        self._inflight = {}             # user_id -> bajarilayotgan so'rov
+        self.hits = 0
+        self.misses = 0
+
+    def _touch(self, user_id):
+        self._active[user_id] = time.monotonic()
+        self._active.move_to_end(user_id)
+        while len(self._active) > self.maxsize:
+            self._active.popitem(last=False)
+
+    def _store(self, user_id, status):
+        ttl = self.positive_ttl if status else self.negative_ttl
+        self._data[user_id] = (time.monotonic() + ttl, status)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def _load(self, user_id, fetch):
+        status = await fetch(user_id)
+        self._store(user_id, status)
+        return status
+
+    async def check(self, user_id, fetch, force=False):
+        """force=True keshni chetlab o'tadi ("obunani tekshirish" tugmasi uchun)"""
+        self._touch(user_id)
+        if not force:
+            item = self._data.get(user_id)
+            if item is not None and item[0] > time.monotonic():
+                self.hits += 1
+                return item[1]
+        self.misses += 1
+        return await self._load_shared(user_id, fetch)
+
+    async def _load_shared(self, user_id, fetch):
+        # Bir userga parallel tekshiruvlar bitta tarmoq so'rovini bo'lishadi
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(user_id, fetch))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _t: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    def invalidate(self, user_id):
+        self._data.pop(user_id, None)
+
+    async def refresh_loop(self, fetch, interval, window, concurrency=5):
+        """Yaqinda faol bo'lgan userlar holatini fonda qayta tekshiradi.
+        Yangilash userni faol deb belgilamaydi va hit/miss hisobiga kirmaydi"""
+        sem = asyncio.Semaphore(concurrency)
+
+        async def refresh_one(uid):
+            async with sem:
+                try:
+                    await self._load_shared(uid, fetch)
+                except Exception as e:
+                    logger.warning(f"Obunani yangilashda xato ({uid}): {e}")
+
+        while True:
+            await asyncio.sleep(interval)
+            border = time.monotonic() - window
+            # _active kirish tartibida: oynadan chiqqanlar boshidan olib tashlanadi
+            while self._active and next(iter(self._active.values())) < border:
+                self._active.popitem(last=False)
+            uids = list(self._active)
+            if uids:
+                await asyncio.gather(*(refresh_one(uid) for uid in uids))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+sub_cache = SubscriptionCache(SUB_CACHE_POSITIVE_TTL, SUB_CACHE_NEGATIVE_TTL, SUB_CACHE_SIZE)
+
+async def fetch_sub_status(user_id):
+    with metrics.timer('check_sub'):
         member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ['creator', 'administrator', 'member']
+    return member.status in ['creator', 'administrator', 'member']
+
+async def check_sub(user_id, force=False):
+    try:
+        return await sub_cache.check(user_id, fetch_sub_status, force=force)
     except Exception:
         return True 
 
@@ -630,10 +3090,9 @@ async def start_cmd(message: types.Message, command: CommandObject, state: FSMCo
         referrer_id = int(command.args)
         if referrer_id == user_id: referrer_id = None
 
-    is_new = await db.add_user(user_id, user.username, user.first_name, user.last_name, referrer_id)
+    is_new = await db.add_user(user_id, user.username, user.first_name, user.last_name, referrer_id, referral_bonus=1)
     
     if is_new and referrer_id:
-        await db.update_balance(referrer_id, 1)
         try:
             await bot.send_message(referrer_id, 
                 "🎉 **Tabriklaymiz!**\nSizning havolangiz orqali yangi foydalanuvchi qo'shildi.\n💰 Hisobingizga **+1 slayd** qo'shildi!")
@@ -650,7 +3109,7 @@ async def start_cmd(message: types.Message, command: CommandObject, state: FSMCo
 
 @dp.callback_query(F.data == "check_sub")
 async def check_sub_callback(callback: CallbackQuery):
-    if await check_sub(callback.from_user.id):
+    if await check_sub(callback.from_user.id, force=True):
         await callback.message.delete()
         user = await db.get_user(callback.from_user.id)
         lang = user['lang'] if user else 'uz'
@@ -678,7 +3137,7 @@ async def admin_add_balance_cmd(message: types.Message):
         if len(parts) != 3: return await message.answer("❌ Format: /add_USERID_AMOUNT")
         target_id = int(parts[1])
         amount = int(parts[2])
-        await db.update_balance(target_id, amount)
+        await db.update_balance(target_id, amount, 'admin')
         await message.answer(f"✅ User {target_id} balansiga +{amount} slayd qo'shildi!")
     except Exception as e:
         await message.answer(f"❌ Xato: {e}")
@@ -696,33 +3155,33 @@ async def admin_vip_cmd(message: types.Message):
 # ----------------- STATE HANDLERS -----------------
 @dp.message(UserStates.waiting_package_choice)
 async def process_package_choice(message: types.Message, state: FSMContext):
-    uid = message.from_user.id
-    user = await db.get_user(uid)
-    l = user['lang']
-    package_btns = get_text(l, 'package_btns')
-    text = message.text
-    chosen = None
-    if text == package_btns[0]: chosen = ("1_slide", 1)
-    elif text == package_btns[1]: chosen = ("5_slides", 5)
-    elif text == package_btns[2]: chosen = ("vip_premium", 999)
-    elif text == get_text(l, 'cancel'):
+    action, chosen, l = BUTTON_ROUTES.get(message.text, NO_ROUTE)
+    if l is None:
+        user = await db.get_user(message.from_user.id)
+        l = user['lang'] if user else 'uz'
+    if action == 'package':
+        await choose_package(message, state, l, chosen)
+    elif action == 'cancel':
         await state.clear()
-        return await show_main_menu(message, l)
-    
-    if chosen:
-        await state.update_data(chosen_package=chosen[0], amount=chosen[1])
-        kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=get_text(l, 'cancel'))]], resize_keyboard=True)
-        await message.answer(get_text(l, 'send_check_now'), reply_markup=kb, parse_mode="Markdown")
-        await state.set_state(UserStates.waiting_for_payment)
+        await show_main_menu(message, l)
     else:
         await message.answer(get_text(l, 'choose_package'))
 
+async def choose_package(message: types.Message, state: FSMContext, l, chosen):
+    await state.update_data(chosen_package=chosen[0], amount=chosen[1])
+    kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=get_text(l, 'cancel'))]], resize_keyboard=True)
+    await message.answer(get_text(l, 'send_check_now'), reply_markup=kb, parse_mode="Markdown")
+    await state.set_state(UserStates.waiting_for_payment)
+
 @dp.message(UserStates.waiting_for_payment, F.photo)
 async def process_payment(message: types.Message, state: FSMContext):
     if not ADMIN_ID: return await message.answer("❌ Admin sozlanmagan.")
     uid = message.from_user.id
     user = await db.get_user(uid)
-    lang = user['lang'] if user else 'uz'
+    if not user:
+        await state.clear()
+        return await message.answer("⚠️ Iltimos /start buyrug'ini bosing.")
+    lang = user['lang']
     data = await state.get_data()
     package_type = data.get('chosen_package')
     amount = data.get('amount')
@@ -752,21 +3211,181 @@ async def admin_broadcast_send(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    users = await db.get_all_users()
-    count = 0
-    await message.answer("⏳ Yuborish boshlandi...")
-    for user_row in users:
-        try:
-            target_id = user_row['id']
-            if message.text: await bot.send_message(target_id, message.text, parse_mode="Markdown")
-            elif message.photo: await bot.send_photo(target_id, message.photo[-1].file_id, caption=message.caption)
-            count += 1
-            await asyncio.sleep(0.05)
-        except Exception: pass
-    await message.answer(f"✅ Xabar {count} ta foydalanuvchiga yuborildi.")
+    if not message.text and not message.photo:
+        return await message.answer("⚠️ Faqat matn yoki rasm yuborish mumkin.")
+    photo_id = message.photo[-1].file_id if message.photo else None
+    broadcast_id = await db.create_broadcast(message.from_user.id, message.text, photo_id, message.caption,
+                                             INSTANCE_ID, BROADCAST_LEASE)
+    progress_msg = await message.answer(f"⏳ Yuborish boshlandi (#{broadcast_id})...", parse_mode=None)
+    # Fon vazifasi - admin handleri band bo'lib qolmaydi
+    start_broadcast_task(broadcast_id, progress_msg)
     await state.clear()
 
 # --- QUIZ HANDLER ---
+class QuizCache:
+    """file_unique_id bo'yicha hujjat matni va (til bo'yicha) tayyor quiz keshi"""
+    def __init__(self, database, max_bytes):
+        self.db = database
+        # Matnlar budjetning asosiy qismini oladi, quizlar kichik
+        self.text_budget = max_bytes * 9 // 10
+        self.quiz_budget = max_bytes - self.text_budget
+        self.quiz_hits = 0
+        self.text_hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    async def get_quiz(self, file_unique_id, lang):
+        quiz = await self.db.get_cached_quiz(file_unique_id, lang)
+        if quiz is None:
+            return None
+        try:
+            questions = json.loads(quiz)
+        except ValueError:
+            return None  # eski (matn) formatdagi yozuv - qayta tuziladi
+        self.quiz_hits += 1
+        return questions
+
+    async def get_text(self, file_unique_id):
+        text = await self.db.get_cached_doc_text(file_unique_id)
+        if text is not None:
+            self.text_hits += 1
+        else:
+            self.misses += 1
+        return text
+
+    async def _maybe_prune(self):
+        self._puts += 1
+        if self._puts % 50 == 1:
+            await self.db.prune_quiz_cache(self.text_budget, self.quiz_budget)
+
+    async def put_text(self, file_unique_id, text):
+        await self.db.put_cached_doc_text(file_unique_id, text)
+        await self._maybe_prune()
+
+    async def put_quiz(self, file_unique_id, lang, questions):
+        await self.db.put_cached_quiz(file_unique_id, lang, json.dumps(questions, ensure_ascii=False))
+        await self._maybe_prune()
+
+    async def stats(self):
+        total = self.quiz_hits + self.text_hits + self.misses
+        return {
+            **await self.db.quiz_cache_size(),
+            'quiz_hits': self.quiz_hits,
+            'text_hits': self.text_hits,
+            'misses': self.misses,
+            'hit_rate': (self.quiz_hits + self.text_hits) / total if total else 0.0
+        }
+
+quiz_cache = QuizCache(db, QUIZ_CACHE_MAX_BYTES)
+
+async def generate_quiz_chunk(text, lang, count):
+    prompt = (
+        f"Analyze the following text and create {count} multiple-choice questions (Quiz). "
+        f"Language: {lang}. "
+        f"Return ONLY JSON in this format:\n"
+        f'{{"questions": [{{"question": "...", "options": ["...", "...", "...", "..."], '
+        f'"correct": 0, "explanation": "..."}}]}}\n'
+        f"'correct' is the 0-based index of the right option. "
+        f"Question max {POLL_QUESTION_MAX} characters, each option max {POLL_OPTION_MAX}, "
+        f"explanation max {POLL_EXPLANATION_MAX}.\n\n"
+        f"Text:\n{text}"
+    )
+    chat_completion = await llm.create(
+        messages=[
+            {"role": "system", "content": "You are a helpful education assistant. Generate a quiz from the provided text as JSON."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.5,
+        max_tokens=2000,
+        response_format={"type": "json_object"}
+    )
+    return parse_quiz_payload(chat_completion.choices[0].message.content)
+
+async def generate_quiz(text, lang, count):
+    """Butun hujjat bo'yicha quiz: bo'laklarga map, savollarni birlashtirish (reduce)"""
+    chunks = split_text_chunks(text, QUIZ_CHUNK_TOKENS * CHARS_PER_TOKEN)
+    if len(chunks) <= 1:
+        return (await generate_quiz_chunk(text, lang, count))[:count]
+
+    # Juda katta hujjatlarda bo'laklar butun hujjat bo'ylab teng tanlanadi
+    chunks = pick_spread(chunks, QUIZ_MAX_CHUNKS)
+    per_chunk_count = max(2, -(-count * 3 // (2 * len(chunks))))  # ~1.5x ortiqcha, takrorlar uchun
+    per_chunk = [[] for _ in chunks]
+    errors = []
+    pending = iter(enumerate(chunks))
+
+    async def lane(extra):
+        # Birinchi yo'lak vazifaning o'z slotida; qo'shimchalari navbatdan olingan slotlarda ishlaydi
+        try:
+            for i, chunk in pending:
+                try:
+                    per_chunk[i] = await generate_quiz_chunk(chunk, lang, per_chunk_count)
+                except Exception as e:
+                    logger.warning(f"Quiz bo'lagida xato: {e}")
+                    errors.append(e)
+                # Navbatda kutayotganlar paydo bo'lsa qo'shimcha slot darhol qaytariladi
+                if extra and job_scheduler.queue_length():
+                    break
+        finally:
+            if extra:
+                job_scheduler.release_extra()
+
+    lanes = [lane(False)]
+    while len(lanes) < min(QUIZ_FANOUT, len(chunks)) and job_scheduler.try_acquire_extra():
+        lanes.append(lane(True))
+    await asyncio.gather(*lanes)
+    if len(errors) == len(chunks):
+        # Hech bir bo'lak tuzilmadi - bu LLM xatosi, fayl o'qish xatosi emas
+        raise errors[0]
+    return merge_quiz_questions(per_chunk, count)
+
+async def send_quiz_poll(chat_id, q, num, total, attempts=3):
+    title = f"{num}/{total}. {q['question']}"
+    if len(title) > POLL_QUESTION_MAX:
+        title = q['question']
+    for _ in range(attempts):
+        await send_limiter.acquire(chat_id)
+        try:
+            # LLM matni oddiy matn sifatida: botning standart Markdown parse_mode'i '_', '*' larni buzadi
+            await bot.send_poll(chat_id, question=title, options=q['options'], type='quiz',
+                                correct_option_id=q['correct'], explanation=q['explanation'] or None,
+                                question_parse_mode=None, explanation_parse_mode=None)
+            return True
+        except TelegramRetryAfter as e:
+            send_limiter.pause(e.retry_after)
+        except Exception as e:
+            logger.warning(f"Quiz poll -> {chat_id}: {e}")
+            return False
+    return False
+
+async def send_quiz_polls(chat_id, questions):
+    """Savollarni quiz poll qilib yuboradi: cheklangan parallellik, chat limiti send_limiter orqali.
+    Yuborib bo'lmagan savollarni qaytaradi"""
+    sem = asyncio.Semaphore(QUIZ_POLL_CONCURRENCY)
+    total = len(questions)
+
+    async def send(num, q):
+        # Navbat tartibi saqlanadi: semafor va chat oralig'i so'rovlar tartibida beriladi
+        async with sem:
+            return await send_quiz_poll(chat_id, q, num, total)
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(send(i, q) for i, q in enumerate(questions, 1)))
+    elapsed = time.monotonic() - started
+    metrics.observe('quiz_polls', elapsed)
+    logger.info(f"Quiz: {sum(results)}/{total} poll {elapsed:.1f}s da yuborildi ({chat_id})")
+    return [q for q, ok in zip(questions, results) if not ok]
+
+async def send_quiz_text(message, uid, questions):
+    quiz_text = format_quiz_text(questions)
+    # Uzun bo'lsa - diskka yozmasdan, xotiradan fayl qilib yuboriladi
+    if len(quiz_text) > 4000:
+        document = BufferedInputFile(quiz_text.encode('utf-8'), filename=f"Quiz_{uid}.txt")
+        with metrics.timer('upload'):
+            await bot.send_document(uid, document, caption="✅ **Quiz tayyor!**")
+    else:
+        await message.answer(f"📝 **QUIZ TEST:**\n\n{quiz_text}", parse_mode=None)
+
 @dp.message(UserStates.waiting_for_quiz_file, F.document)
 async def quiz_file_handler(message: types.Message, state: FSMContext):
     uid = message.from_user.id
@@ -779,57 +3398,69 @@ async def quiz_file_handler(message: types.Message, state: FSMContext):
     if file_ext not in ['pdf', 'docx', 'txt']:
         return await message.answer("⚠️ Iltimos faqat .PDF, .DOCX yoki .TXT fayl yuboring!")
 
-    await message.answer(get_text(l, 'quiz_processing'))
-    await bot.send_chat_action(uid, 'typing')
+    file_size = message.document.file_size or 0
+    if file_size > QUIZ_MAX_FILE_SIZE:
+        return await message.answer(get_text(l, 'file_too_big').format(mb=QUIZ_MAX_FILE_SIZE // (1024 * 1024)))
 
-    file_id = message.document.file_id
-    file = await bot.get_file(file_id)
-    file_path = file.file_path
-    downloaded_file = f"temp_{uid}.{file_ext}"
+    status_msg = await message.answer(get_text(l, 'quiz_processing'))
+    await bot.send_chat_action(uid, 'typing')
 
+    spool_path = None
+    acquired = False
     try:
-        await bot.download_file(file_path, downloaded_file)
-        text_content = extract_text_from_file(downloaded_file)
-
-        if not text_content or len(text_content.strip()) < 50:
-            os.remove(downloaded_file)
-            return await message.answer(get_text(l, 'quiz_error'))
-
-        prompt = (
-            f"Analyze the following text and create 10 multiple-choice questions (Quiz). "
-            f"Language: {l}. "
-            f"Format:\n1. Question?\nA) ...\nB) ...\nC) ...\nAnswer: A\n\n"
-            f"Text:\n{text_content}"
-        )
-
-        chat_completion = await client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": "You are a helpful education assistant. Generate a quiz from the provided text."},
-                {"role": "user", "content": prompt}
-            ],
-            model="llama-3.3-70b-versatile",
-            temperature=0.5,
-            max_tokens=2000
-        )
-
-        quiz_result = chat_completion.choices[0].message.content
-        
-        # Javobni fayl qilib yuborish (uzun bo'lsa)
-        if len(quiz_result) > 4000:
-            result_file = f"Quiz_{uid}.txt"
-            with open(result_file, 'w', encoding='utf-8') as f:
-                f.write(quiz_result)
-            await bot.send_document(uid, FSInputFile(result_file), caption="✅ **Quiz tayyor!**")
-            os.remove(result_file)
-        else:
-            await message.answer(f"📝 **QUIZ TEST:**\n\n{quiz_result}", parse_mode=None)
-
+        file_unique_id = message.document.file_unique_id
+        # Shu hujjat uchun quiz tayyor bo'lsa - yuklash, o'qish va LLM'siz javob
+        questions = await quiz_cache.get_quiz(file_unique_id, l)
+        if questions is None:
+            await job_scheduler.acquire(uid, bool(user['is_premium']), queue_position_notifier(status_msg, l))
+            acquired = True
+            text_content = await quiz_cache.get_text(file_unique_id)
+            if text_content is None:
+                file = await bot.get_file(message.document.file_id)
+                with metrics.timer('download'):
+                    if file_size <= DOWNLOAD_SPOOL_SIZE:
+                        # Kichik fayllar to'g'ridan-to'g'ri xotiraga yuklanadi
+                        buffer = await bot.download_file(file.file_path, io.BytesIO())
+                        source = buffer.getvalue()
+                    else:
+                        # Kattalari noyob nomli vaqtinchalik faylga (bir xil userning parallel yuklashlari to'qnashmaydi)
+                        with tempfile.NamedTemporaryFile(prefix="quiz_", suffix=f".{file_ext}", delete=False) as tmp:
+                            spool_path = tmp.name
+                        await bot.download_file(file.file_path, spool_path)
+                        source = spool_path
+                try:
+                    with metrics.timer('extract'):
+                        text_content = await extract_pool.run(extract_text_from_file, source, file_ext, QUIZ_DOC_CHAR_LIMIT,
+                                                              timeout=EXTRACT_KILL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning(f"⏱ Fayl {EXTRACT_KILL_TIMEOUT:.0f}s da o'qilmadi, worker qayta ishga tushirildi ({file_ext})")
+                    text_content = None
+
+                if not text_content or len(text_content.strip()) < 50:
+                    return await message.answer(get_text(l, 'quiz_error'))
+                await quiz_cache.put_text(file_unique_id, text_content)
+
+            questions = await generate_quiz(text_content, l, QUIZ_QUESTION_COUNT)
+            if not questions:
+                return await message.answer(get_text(l, 'quiz_error'))
+            await quiz_cache.put_quiz(file_unique_id, l, questions)
+
+        # Poll'lar bitta partiya bo'lib yuboriladi; yuborilmaganlari matn/fayl ko'rinishida
+        unsent = await send_quiz_polls(uid, questions) if QUIZ_AS_POLLS else questions
+        if unsent:
+            await send_quiz_text(message, uid, unsent)
+
+    except JobRejected as e:
+        await message.answer(get_text(l, 'job_active' if e.reason == 'duplicate' else 'busy'))
+    except PoolQueueFull:
+        await message.answer(get_text(l, 'busy'))
     except Exception as e:
         logger.error(f"Quiz Error: {e}")
         await message.answer(get_text(l, 'error'))
     finally:
-        if os.path.exists(downloaded_file):
-            os.remove(downloaded_file)
+        if acquired: job_scheduler.release(uid)
+        if spool_path and os.path.exists(spool_path):
+            os.remove(spool_path)
         await state.clear()
         await show_main_menu(message, l)
 
@@ -838,22 +3469,26 @@ async def quiz_file_handler(message: types.Message, state: FSMContext):
 @dp.message(F.text)
 async def main_handler(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    user = await db.get_user(uid)
-    if not user: return await message.answer("⚠️ Iltimos /start buyrug'ini bosing.")
-    l = user['lang']
-    btns = get_text(l, 'btns')
     text = message.text
-
-    if text == btns[0]: # Tariflar
+    # Tugma qaysi tilda bo'lsa, javob ham o'sha tilda; baza faqat user qatori kerak bo'lganda o'qiladi.
+    # To'lov va quiz oqimlariga (yozuvga olib boradi) faqat ro'yxatdan o'tgan userlar kiradi
+    action, arg, l = BUTTON_ROUTES.get(text, NO_ROUTE)
+    user = None
+    if l is None or action in (None, 'cabinet', 'tariff', 'package', 'quiz'):
+        user = await db.get_user(uid)
+        if not user: return await message.answer("⚠️ Iltimos /start buyrug'ini bosing.")
+        l = l or user['lang']
+
+    if action == 'tariff':
         p_btns = get_text(l, 'package_btns')
         kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=p_btns[0]), KeyboardButton(text=p_btns[1])],[KeyboardButton(text=p_btns[2])],[KeyboardButton(text=get_text(l, 'cancel'))]], resize_keyboard=True)
         await message.answer(get_text(l, 'tarif'), reply_markup=kb)
         await state.set_state(UserStates.waiting_package_choice)
-    elif text == btns[1]: # Kabinet
+    elif action == 'cabinet':
         status = "⭐ VIP PREMIUM" if user['is_premium'] else "👤 Oddiy"
         msg = (f"📊 **SHAXSIY KABINET**\n\n👤 Ism: {user['first_name']}\n🆔 ID: `{uid}`\n💰 Balans: **{user['balance']} slayd**\n🏷 Status: **{status}**")
         await message.answer(msg, parse_mode="Markdown")
-    elif text == btns[2]: # Taklif
+    elif action == 'invite':
         bot_info = await bot.get_me()
         link = f"https://t.me/{bot_info.username}?start={uid}"
     
@@ -872,19 +3507,19 @@ async def main_handler(message: types.Message, state: FSMContext):
 ✨ **Bonuslar cheksiz!** Qancha ko'p do'st taklif qilsangiz, shuncha ko'p bepul slaydlar olasiz!"""
     
         kb = ReplyKeyboardMarkup(keyboard=[
-            [KeyboardButton(text="📤 Ulashish", request_contact=False)],
+            [KeyboardButton(text=SHARE_BTN, request_contact=False)],
             [KeyboardButton(text=get_text(l, 'cancel'))]
         ], resize_keyboard=True)
     
         await message.answer(promo, reply_markup=kb, parse_mode="Markdown")
-    elif text == btns[3]: # Quiz Test (YANGI)
+    elif action == 'quiz':
         kb = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text=get_text(l, 'cancel'))]], resize_keyboard=True)
         await message.answer(get_text(l, 'quiz_prompt'), reply_markup=kb, parse_mode="Markdown")
         await state.set_state(UserStates.waiting_for_quiz_file)
-    elif text == btns[4]: # Til
+    elif action == 'lang':
         ikb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🇺🇿 O'zbekcha", callback_data="lang_uz")], [InlineKeyboardButton(text="🇷🇺 Русский", callback_data="lang_ru")], [InlineKeyboardButton(text="🇬🇧 English", callback_data="lang_en")]])
         await message.answer("Tilni tanlang / Select language:", reply_markup=ikb)
-    elif text == "📤 Ulashish":
+    elif action == 'share':
         bot_info = await bot.get_me()
         link = f"https://t.me/{bot_info.username}?start={uid}"
         
@@ -904,7 +3539,10 @@ async def main_handler(message: types.Message, state: FSMContext):
         
         # Havolani alohida ham berish
         await message.answer(f"🔗 **Havola:** `{link}`\n\n📋 *Havolani nusxalash uchun ustiga bosing*", parse_mode="Markdown")
-    elif text == get_text(l, 'cancel'):
+    elif action == 'package':
+        # Holat eskirgan bo'lsa ham paket tugmasi to'lov bosqichiga olib o'tadi
+        await choose_package(message, state, l, arg)
+    elif action == 'cancel':
         await state.clear()
         await show_main_menu(message, l)
     else:
@@ -918,27 +3556,17 @@ async def main_handler(message: types.Message, state: FSMContext):
 async def admin_confirm_payment(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
     pid = int(callback.data.split("_")[1])
-    async with aiosqlite.connect(DB_PATH) as db_conn:
-        db_conn.row_factory = aiosqlite.Row
-        cur = await db_conn.execute("SELECT * FROM payments WHERE id = ?", (pid,))
-        pay = await cur.fetchone()
-        if not pay or pay['status'] != 'pending': return await callback.answer("Eskirgan!", show_alert=True)
-        uid, amt, p_type = pay['user_id'], pay['amount'], pay['package_type']
-        await db_conn.execute("UPDATE payments SET status = 'approved' WHERE id = ?", (pid,))
-        if p_type == 'vip_premium': await db_conn.execute("UPDATE users SET is_premium = 1 WHERE id = ?", (uid,))
-        else: await db_conn.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amt, uid))
-        await db_conn.commit()
-        try: await bot.send_message(uid, get_text('uz', 'balance_added').format(amount=amt))
-        except: pass
+    pay = await db.confirm_payment(pid)
+    if not pay: return await callback.answer("Eskirgan!", show_alert=True)
+    try: await bot.send_message(pay['user_id'], get_text('uz', 'balance_added').format(amount=pay['amount']))
+    except: pass
     await callback.message.edit_caption(caption=f"✅ Tasdiqlandi!\nID: {pid}")
 
 @dp.callback_query(F.data.startswith("reject_"))
 async def admin_reject_payment(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
     pid = int(callback.data.split("_")[1])
-    async with aiosqlite.connect(DB_PATH) as db_conn:
-        await db_conn.execute("UPDATE payments SET status = 'rejected' WHERE id = ?", (pid,))
-        await db_conn.commit()
+    await db.reject_payment(pid)
     await callback.message.edit_caption(caption=f"❌ Rad etildi!\nID: {pid}")
 
 @dp.callback_query(F.data.startswith("lang_"))
@@ -952,7 +3580,46 @@ async def change_lang(callback: CallbackQuery):
 async def admin_stats_callback(callback: CallbackQuery):
     if callback.from_user.id != ADMIN_ID: return
     st = await db.get_stats()
-    await callback.message.answer(f"📊 **STATISTIKA**\n👥 Userlar: {st['total_users']}\n⭐ VIP: {st['premium_users']}\n📈 Slaydlar: {st['total_slides']}", parse_mode="Markdown")
+    uc = db.user_cache.stats()
+    sc = sub_cache.stats()
+    rp = render_pool.stats()
+    ep = extract_pool.stats()
+    dc = await deck_cache.stats()
+    js = job_scheduler.stats()
+    qc = await quiz_cache.stats()
+    fs = fsm_storage.stats() if isinstance(fsm_storage, SQLiteStorage) else None
+    wb = db.batcher.stats()
+    wl = db.write_lock_stats()
+    stage_lines = "".join(
+        f"\n⏱ {stage}: {m['count']} ta, p50 {m['p50'] * 1000:.0f} ms, p95 {m['p95'] * 1000:.0f} ms"
+        for stage, m in ((k.replace('_', r'\_'), v) for k, v in metrics.summary().items() if not k.startswith('handler:')))
+    updates = sum(v for (name, _), v in metrics.counters.items() if name == 'updates_total')
+    errors = sum(v for (name, _), v in metrics.counters.items() if name.endswith('errors_total'))
+    llm_lines = "".join(
+        f"\n🤖 {model}: {m['count']} ta, p50 {m['p50']:.1f}s, p95 {m['p95']:.1f}s, xato {m['errors']}"
+        for model, m in llm.stats().items())
+    await callback.message.answer(
+        f"📊 **STATISTIKA**\n👥 Userlar: {st['total_users']}\n⭐ VIP: {st['premium_users']}\n📈 Slaydlar: {st['total_slides']}"
+        f"\n\n🗄 User kesh: {uc['size']} ta, hit {uc['hits']} / miss {uc['misses']} ({uc['hit_rate']:.0%})"
+        f"\n📢 Obuna kesh: {sc['size']} ta, hit {sc['hits']} / miss {sc['misses']} ({sc['hit_rate']:.0%})"
+        f"\n🖨 Render: {rp['workers']} worker, navbat {rp['pending']}, rad {rp['rejected']}, "
+        f"kutish {rp['wait_avg']:.2f}s, render {rp['run_avg']:.2f}s (max {rp['run_max']:.2f}s)"
+        f"\n📄 Fayl o'qish: {ep['workers']} worker, navbat {ep['pending']}, rad {ep['rejected']}, muddat o'tgan {ep['timeouts']} (qayta {ep['retried']}), "
+        f"kutish {ep['wait_avg']:.2f}s, o'qish {ep['run_avg']:.2f}s (max {ep['run_max']:.2f}s)"
+        f"\n🗂 Deck kesh: {dc['size']} ta, file {dc['file_hits']} / json {dc['json_hits']} / miss {dc['misses']} ({dc['hit_rate']:.0%})"
+        f"\n🚦 Navbat: {js['running']} ishlamoqda, {js['queued']} kutmoqda, rad {js['rejected_duplicate']}+{js['rejected_full']}, "
+        f"kutish {js['wait_avg']:.1f}s (max {js['wait_max']:.1f}s)"
+        f"\n📝 Quiz kesh: {qc['docs']} hujjat, {qc['quizzes']} quiz, {qc['bytes'] / 1048576:.1f} MB, "
+        f"quiz {qc['quiz_hits']} / matn {qc['text_hits']} / miss {qc['misses']} ({qc['hit_rate']:.0%})"
+        + (f"\n💾 FSM: {fs['writes']} o'zgarish -> {fs['rows']} qator, {fs['flushes']} tranzaksiya, kutmoqda {fs['pending']}" if fs else "")
+        + f"\n🧮 Jamlangan yozuvlar: {wb['ops']} amal -> {wb['rows']} qator, {wb['batches']} tranzaksiya "
+        f"(o'rtacha {wb['batch_avg']:.0f}, max {wb['batch_max']}), flush {wb['flush_avg'] * 1000:.1f} ms (max {wb['flush_max'] * 1000:.1f} ms)"
+        f"\n🔒 Yozish qulfi: {wl['acquired']} marta, kutish {wl['wait_avg'] * 1000:.1f} ms (max {wl['wait_max'] * 1000:.1f} ms)"
+        f"\n🪵 Log: tashlangan {log_queue_handler.dropped}, takror yashirilgan {log_queue_handler.dedup.suppressed}, "
+        f"navbat {log_queue_handler.queue.qsize()}"
+        f"\n🤖 LLM: hedge {llm.hedges}, zaxira model {llm.fallbacks}{llm_lines}"
+        f"\n\n📈 Updatelar: {updates}, xatolar: {errors}{stage_lines}",
+        parse_mode="Markdown")
 
 @dp.callback_query(F.data == "admin_broadcast")
 async def admin_broadcast_start(callback: CallbackQuery, state: FSMContext):
@@ -966,52 +3633,244 @@ async def generate_ppt(callback: CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
     user = await db.get_user(uid)
     l = user['lang']
-    if not user['is_premium'] and user['balance'] <= 0: return await callback.message.answer(get_text(l, 'no_bal'))
-    
-    cnt = callback.data.split(":")[1]
-    data = await state.get_data()
-    topic = data.get('topic')
-    wait_msg = await callback.message.answer(get_text(l, 'wait'))
-    await bot.send_chat_action(uid, action="typing")
-    path = None
+    # Kredit LLM chaqiruvidan oldin atomar band qilinadi (VIP'lar uchun shart emas)
+    reservation_id = None
+    if not user['is_premium']:
+        reservation_id = await db.reserve_credit(uid)
+        if reservation_id is None: return await callback.message.answer(get_text(l, 'no_bal'))
+
+    # Band qilingan kredit shu yerdan boshlab finally'da tasdiqlanadi yoki qaytariladi
+    wait_msg = None
+    topic = None
+    from_cache = False
+    acquired = False
     try:
-        lang_instr = {'uz': "IN UZBEK", 'ru': "IN RUSSIAN", 'en': "IN ENGLISH"}.get(l, "IN UZBEK")
-        sys_p = ("You are a Senior Presentation Consultant. "
-                 f"STRICTLY {lang_instr}. Create dense content. "
-                 "Return ONLY VALID JSON: {'slides': [{'title': '...', 'content': [{'bold': '...', 'text': '...'}], 'stat': '...', 'insight': '...'}]}")
-        usr_p = f"Create {cnt}-slide presentation on '{topic}'."
-        
-        comp = await client.chat.completions.create(messages=[{"role":"system","content":sys_p},{"role":"user","content":usr_p}], model="llama-3.3-70b-versatile", response_format={"type":"json_object"})
-        path = await asyncio.to_thread(create_ultra_modern_pptx, topic, comp.choices[0].message.content, uid)
-        
-        if path:
-            await bot.send_document(uid, FSInputFile(path), caption=get_text(l, 'done'))
-            if not user['is_premium']: await db.update_balance(uid, -1)
+        parts = callback.data.split(":")
+        cnt = parts[1]
+        fresh = len(parts) > 2 and parts[2] == "fresh"  # keshni chetlab o'tish
+        data = await state.get_data()
+        topic = data.get('topic')
+        wait_msg = await callback.message.answer(get_text(l, 'wait'))
+        await bot.send_chat_action(uid, action="typing")
+        deck = None
+        cache_key = deck_cache.key(topic, cnt, l)
+        fresh_kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=get_text(l, 'btn_fresh'), callback_data=f"gen:{cnt}:fresh")]])
+        await job_scheduler.acquire(uid, bool(user['is_premium']), queue_position_notifier(wait_msg, l))
+        acquired = True
+        cached = await deck_cache.get(cache_key) if DECK_CACHE_ENABLED and not fresh else None
+        sent = None
+        if cached and cached['file_id']:
+            try:
+                # Telegram'dagi tayyor faylni qayta yuklamasdan yuboramiz
+                with metrics.timer('upload'):
+                    sent = await bot.send_document(uid, cached['file_id'], caption=get_text(l, 'done'), reply_markup=fresh_kb)
+                deck_cache.file_hits += 1
+                from_cache = True
+            except Exception as e:
+                logger.warning(f"Keshdagi file_id yaroqsiz: {e}")
+
+        if not sent:
+            if cached and cached['slides_json']:
+                deck_cache.json_hits += 1
+                from_cache = True
+                slides_json = cached['slides_json']
+                with metrics.timer('render'):
+                    deck = await render_pool.run(create_ultra_modern_pptx, topic, slides_json)
+            else:
+                lang_instr = {'uz': "IN UZBEK", 'ru': "IN RUSSIAN", 'en': "IN ENGLISH"}.get(l, "IN UZBEK")
+                sys_p = ("You are a Senior Presentation Consultant. "
+                         f"STRICTLY {lang_instr}. Create dense content. "
+                         "Return ONLY VALID JSON: {'slides': [{'title': '...', 'content': [{'bold': '...', 'text': '...'}], 'stat': '...', 'insight': '...'}]}")
+                usr_p = f"Create {cnt}-slide presentation on '{topic}'."
+                messages = [{"role":"system","content":sys_p},{"role":"user","content":usr_p}]
+
+                if STREAM_GENERATION:
+                    async def on_progress(done):
+                        try: await wait_msg.edit_text(get_text(l, 'progress').format(done=done, total=cnt))
+                        except Exception: pass
+                    deck, slides_json = await generate_deck_streaming(messages, topic, on_progress)
+                else:
+                    deck, slides_json = await generate_deck_blocking(messages, topic)
+
+            if deck:
+                filename, data = deck
+                with metrics.timer('upload'):
+                    sent = await bot.send_document(uid, BufferedInputFile(data, filename=filename), caption=get_text(l, 'done'),
+                                                   reply_markup=fresh_kb if from_cache else None)
+                if DECK_CACHE_ENABLED and sent.document:
+                    try: await deck_cache.put(cache_key, topic, cnt, l, slides_json, sent.document.file_id)
+                    except Exception as e: logger.warning(f"Deck keshga yozilmadi: {e}")
+
+        if sent:
+            # Deck yetkazildi: bundan keyin xato ko'rsatilmaydi va kredit qaytarilmaydi
+            if reservation_id:
+                delivered, reservation_id = reservation_id, None
+                await commit_delivered_reservation(delivered)
         else: await callback.message.answer(get_text(l, 'error'))
+    except JobRejected as e:
+        await callback.message.answer(get_text(l, 'job_active' if e.reason == 'duplicate' else 'busy'))
+    except PoolQueueFull:
+        await callback.message.answer(get_text(l, 'busy'))
     except Exception as e:
         logger.error(f"Gen Error: {e}")
         await callback.message.answer(get_text(l, 'error'))
     finally:
-        try: await wait_msg.delete()
-        except: pass
-        await state.clear()
-        if path and os.path.exists(path):
-            await asyncio.sleep(2)
-            try: os.remove(path)
+        if acquired: job_scheduler.release(uid)
+        # Yetkazilmagan bo'lsa band qilingan kredit qaytariladi
+        if reservation_id: await db.refund_reservation(reservation_id)
+        if wait_msg:
+            try: await wait_msg.delete()
             except: pass
+        await state.clear()
+        if from_cache:
+            # "Yangi variant" tugmasi uchun mavzuni saqlab qolamiz
+            await state.update_data(topic=topic)
+
+# --- 11. WEBHOOK SERVER ---
+class WebhookHandler(SimpleRequestHandler):
+    """Telegramga darhol javob beradi, updatelarni cheklangan parallellikda fonda qayta ishlaydi"""
+    def __init__(self, dispatcher, bot, secret_token, workers, backlog):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token)
+        self.slots = asyncio.Semaphore(workers)
+        self.backlog = backlog
+        self.accepting = True
+        self.received = 0
+        self.rejected = 0
+
+    async def _background_feed_update(self, bot, update):
+        async with self.slots:
+            await super()._background_feed_update(bot, update)
+
+    async def handle(self, request):
+        # To'xtash jarayonida yoki navbat to'lganda Telegram updateni keyinroq qayta yuboradi
+        if not self.accepting or len(self._background_feed_update_tasks) >= self.backlog:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return await super().handle(request)
+
+    async def drain(self, timeout):
+        """Yangi updatelarni qabul qilmaydi va ishlayotganlarini (generatsiyalarni) tugashini kutadi"""
+        self.accepting = False
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return 0
+        logger.info(f"⏳ {len(tasks)} ta update tugashi kutilmoqda (navbat: {job_scheduler.stats()})")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        return len(pending)
+
+    def stats(self):
+        return {
+            'inflight': len(self._background_feed_update_tasks),
+            'received': self.received,
+            'rejected': self.rejected
+        }
+
+async def healthcheck(request):
+    return web.json_response({'ok': True, 'updates': request.app['webhook'].stats(), 'jobs': job_scheduler.stats()})
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    """/metrics uchun alohida lokal server (polling va webhook rejimlarida bir xil)"""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_endpoint)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Port band (masalan, shu xostdagi boshqa jarayon) - bot metrikalarsiz ishlashda davom etadi
+        logger.error(f"❌ /metrics serverini {METRICS_HOST}:{METRICS_PORT} da ochib bo'lmadi: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Metrikalar: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+async def run_webhook():
+    handler = WebhookHandler(dp, bot, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_BACKLOG)
+    app = web.Application(client_max_size=WEBHOOK_MAX_BODY)
+    app['webhook'] = handler
+    handler.register(app, path=WEBHOOK_PATH)
+    app.router.add_get('/healthz', healthcheck)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                              max_connections=WEBHOOK_MAX_CONNECTIONS,
+                              allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"✅ Bot webhook rejimida ishlamoqda: {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # Avval yangi ulanishlar to'xtatiladi, keyin ishlayotgan generatsiyalar tugatiladi
+        await site.stop()
+        cancelled = await handler.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        if cancelled:
+            logger.warning(f"⚠️ {cancelled} ta update muddat tugagani uchun bekor qilindi")
+        await runner.cleanup()
 
 async def main():
-    await db.init()
-    os.makedirs("slides", exist_ok=True)
-    try: 
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Bot ishga tushdi. Polling rejimida ishlamoqda...")
-    except Exception as e:
-        logger.warning(f"⚠️ Webhook o'chirishda xato: {e}")
-    
-    # Polling rejimida botni ishga tushirish
-    logger.info("🔄 Bot polling rejimida ishga tushmoqda...")
-    await dp.start_polling(bot)
+    background = []
+    metrics_runner = None
+    # Ishga tushish bosqichida xato bo'lsa ham pullar va fon vazifalari finally'da to'xtatiladi
+    try:
+        render_pool.start()
+        extract_pool.start()
+        await db.init()
+        background.append(asyncio.create_task(reservation_janitor(RESERVATION_SWEEP_INTERVAL)))
+        background.append(asyncio.create_task(slides_janitor(SLIDES_JANITOR_INTERVAL, SLIDES_RETENTION)))
+        if isinstance(fsm_storage, SQLiteStorage):
+            background.append(asyncio.create_task(fsm_storage.run()))
+        background.append(asyncio.create_task(db.batcher.run()))
+        if USER_CACHE_SYNC_INTERVAL > 0:
+            background.append(asyncio.create_task(user_cache_sync(USER_CACHE_SYNC_INTERVAL)))
+        if job_scheduler.db is not None:
+            background.append(asyncio.create_task(job_scheduler.heartbeat()))
+        if SUB_REFRESH_INTERVAL > 0:
+            background.append(asyncio.create_task(
+                sub_cache.refresh_loop(fetch_sub_status, SUB_REFRESH_INTERVAL, SUB_REFRESH_WINDOW)))
+        background.append(asyncio.create_task(broadcast_janitor(BROADCAST_LEASE)))
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server()
+        if WEBHOOK_MODE:
+            await run_webhook()
+        else:
+            try: 
+                await bot.delete_webhook(drop_pending_updates=True)
+                logger.info("✅ Bot ishga tushdi. Polling rejimida ishlamoqda...")
+            except Exception as e:
+                logger.warning(f"⚠️ Webhook o'chirishda xato: {e}")
+            
+            # Polling rejimida botni ishga tushirish
+            logger.info("🔄 Bot polling rejimida ishga tushmoqda...")
+            await dp.start_polling(bot)
+    finally:
+        pending = background + list(broadcast_tasks.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        render_pool.shutdown()
+        extract_pool.shutdown()
+        await db.close()
 
 if __name__ == "__main__":
     try: 
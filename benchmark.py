@@ -0,0 +1,422 @@
+"""Slide Master AI - tarmoqsiz benchmark.
+
+Soxta AsyncGroq va soxta Telegram Bot API bilan quyidagilarni o'lchaydi:
+  * render: slayd boshiga vaqt (7/10/15 slayd, uzun bandlar) va JSON tahlili
+  * extract: PDF/DOCX/TXT dan matn o'qish tezligi (sahifa/s)
+  * e2e: aiogram dispatcher orqali parallel userlar bilan updates/s (deck va quiz oqimlari)
+LLM javoblari benchmark_fixtures/ dagi yozib olingan javoblardan (7 slaydli deck, quiz) olinadi,
+boshqa slayd sonlari uchun sintetik. Natijalar benchmark_baseline.json bilan solishtiriladi.
+
+    python benchmark.py                    # hammasi, baseline bilan solishtirish
+    python benchmark.py --only render      # faqat bitta bo'lim
+    python benchmark.py --save-baseline    # joriy natijani baseline qilib saqlash
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, 'benchmark_baseline.json')
+FIXTURES_DIR = os.path.join(BASE_DIR, 'benchmark_fixtures')
+TOKEN = '123456:BENCHMARKbenchmarkBENCHMARKbenchmark'
+
+# ai.py import paytida env o'qiydi, bazani va bot.log'ni joriy papkada ochadi -
+# shuning uchun hammasi vaqtinchalik papkada va soxta kalitlar bilan ishlaydi
+# Pul worker'lari (forkserver) bu faylni __mp_main__ sifatida qayta import qiladi - ular
+# yangi papka ochmaydi, ota jarayon ishlayotgan papkada qoladi
+WORK_DIR = os.getcwd() if __name__ == '__mp_main__' else tempfile.mkdtemp(prefix='slide_bench_')
+os.environ.setdefault('BOT_TOKEN', TOKEN)
+os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('SUB_REFRESH_INTERVAL', '0')
+sys.path.insert(0, BASE_DIR)
+os.chdir(WORK_DIR)
+
+import logging
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from docx import Document
+
+import ai
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+# --- FIXTURELAR ---
+def load_fixture(name):
+    """Yozib olingan LLM javobi (message.content) - o'zgartirilmagan matn"""
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+RECORDED_SLIDES = {7: load_fixture('slides_7_uz.json')}
+RECORDED_QUIZ = load_fixture('quiz_uz.json')
+
+def make_slides_json(count, bullets=4, words=45, seed=0):
+    """Uzun bandli sintetik slaydlar JSON'i (LLM javobiga o'xshash)"""
+    rnd = random.Random(seed)
+    vocab = ("strategiya bozor tahlil o'sish innovatsiya raqamli samaradorlik investitsiya "
+             "texnologiya barqaror rivojlanish xavf mijoz tajriba infratuzilma ma'lumotlar").split()
+    slides = []
+    for i in range(count):
+        slides.append({
+            'title': f"{i + 1}-bo'lim: " + " ".join(rnd.choice(vocab) for _ in range(5)).capitalize(),
+            'content': [{'bold': " ".join(rnd.choice(vocab) for _ in range(3)).capitalize(),
+                         'text': " ".join(rnd.choice(vocab) for _ in range(words))}
+                        for _ in range(bullets)],
+            'stat': f"{rnd.randint(10, 99)}%",
+            'insight': " ".join(rnd.choice(vocab) for _ in range(20))
+        })
+    return json.dumps({'slides': slides}, ensure_ascii=False)
+
+def make_pdf(pages, lines=40):
+    """Matnli PDF (Helvetica, har sahifada `lines` qator) baytlari"""
+    objs = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i * 2} 0 R" for i in range(pages))
+    objs.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+    font_id = 3 + pages * 2
+    for i in range(pages):
+        text = "BT /F1 10 Tf 40 800 Td " + " ".join(
+            f"(Page {i} line {j} lorem ipsum dolor sit amet consectetur) Tj 0 -14 Td" for j in range(lines)) + " ET"
+        objs.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {4 + i * 2} 0 R "
+                    f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode())
+        objs.append(f"<< /Length {len(text)} >>\nstream\n{text}\nendstream".encode())
+    objs.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, obj in enumerate(objs, 1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objs) + 1}\n0000000000 65535 f \n".encode()
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objs) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+PAGE_CHARS = 3000  # DOCX/TXT uchun shartli "sahifa"
+
+def make_docx(pages):
+    doc = Document()
+    line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor. "
+    for i in range(pages):
+        doc.add_paragraph(f"Sahifa {i}: " + line * (PAGE_CHARS // len(line)))
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def make_txt(pages):
+    line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\n"
+    return "".join(f"Sahifa {i}\n" + line * (PAGE_CHARS // len(line)) for i in range(pages)).encode('utf-8')
+
+
+# --- SOXTA AsyncGroq ---
+class FakeGroq:
+    """chat.completions.create: quiz so'roviga yozib olingan quiz, deck so'roviga so'ralgan slayd soni
+    bo'yicha yozib olingan (bo'lmasa sintetik) javob qaytaradi, stream=True ham ishlaydi"""
+    def __init__(self, latency, chunk_size=48):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _payload(self, messages):
+        if 'quiz' in messages[0]['content'].lower():
+            return RECORDED_QUIZ
+        prompt = messages[-1]['content']
+        count = next((int(w.split('-')[0]) for w in prompt.split() if w.split('-')[0].isdigit()), 7)
+        return RECORDED_SLIDES.get(count) or make_slides_json(count, seed=self.calls)
+
+    async def create(self, model=None, messages=(), stream=False, **kwargs):
+        self.calls += 1
+        payload = self._payload(messages)
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=payload))])
+        chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)]
+        delay = self.latency / (len(chunks) + 1)
+
+        async def gen():
+            await asyncio.sleep(delay)  # birinchi token
+            for chunk in chunks:
+                await asyncio.sleep(delay)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+        return gen()
+
+
+# --- SOXTA TELEGRAM BOT API ---
+class FakeBotAPI:
+    """Bot API metodlariga minimal, lekin haqiqiy HTTP javoblar beradigan lokal server.
+    files: file_path -> baytlar (getFile va fayl yuklash uchun)"""
+    def __init__(self, latency, files=None):
+        self.latency = latency
+        self.files = files or {}
+        self.calls = {}
+        self.message_id = 0
+        self.runner = None
+        self.url = None
+
+    def _message(self, chat_id, **extra):
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, **extra}
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        form = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = form.get('chat_id')
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(form.get('user_id', 0)), 'is_bot': False, 'first_name': 'u'}}
+        elif method == 'sendDocument':
+            doc_id = f"doc{self.message_id}"
+            result = self._message(chat_id, document={'file_id': doc_id, 'file_unique_id': doc_id})
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendPoll'):
+            result = self._message(chat_id, text='ok')
+        elif method == 'getFile':
+            file_id = form.get('file_id')
+            path = f"documents/{file_id}"
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': path,
+                      'file_size': len(self.files.get(path, b''))}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def download(self, request):
+        self.calls['download'] = self.calls.get('download', 0) + 1
+        data = self.files.get(request.match_info['path'])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.download)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# --- O'LCHOVLAR ---
+def peak_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024  # Linux'da KB
+
+def bench_render(repeat):
+    results = {}
+    ai.get_slide_chrome(time.strftime('%Y-%m-%d'))  # shablonni qizdirish
+    for count in (7, 10, 15):
+        payload = RECORDED_SLIDES.get(count) or make_slides_json(count)
+        fenced = f"```json\n{payload}\n```"
+        started = time.perf_counter()
+        for _ in range(repeat * 20):
+            json.loads(ai.clean_json_string(fenced))
+        results[f'parse_ms_{count}'] = (time.perf_counter() - started) * 1000 / (repeat * 20)
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            deck = ai.create_ultra_modern_pptx("Benchmark mavzusi", payload)
+            timings.append(time.perf_counter() - started)
+            assert deck, "render xato qaytardi"
+        results[f'render_ms_per_slide_{count}'] = min(timings) * 1000 / count
+        results[f'deck_kb_{count}'] = len(deck[1]) / 1024
+    return results
+
+def bench_extract(pages, repeat):
+    corpus = {'pdf': make_pdf(pages), 'docx': make_docx(pages), 'txt': make_txt(pages)}
+    results = {}
+    for ext, data in corpus.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            text = ai.extract_text_from_file(data, ext, limit=10 ** 9, max_pages=pages, timeout=600)
+            timings.append(time.perf_counter() - started)
+        assert text and len(text) > 1000, f"{ext}: matn o'qilmadi"
+        best = min(timings)
+        results[f'extract_{ext}_pages_per_s'] = pages / best
+        results[f'extract_{ext}_mb_per_s'] = len(data) / 1048576 / best
+    return results
+
+def _user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': f'u{uid}', 'username': f'u{uid}'}
+
+def _chat(uid):
+    return {'id': uid, 'type': 'private'}
+
+QUIZ_DOC = make_pdf(20)
+
+async def bench_e2e(users, quiz_users, llm_latency, tg_latency):
+    # Har bir quiz useri o'z hujjatini yuboradi (alohida file_unique_id) - kesh emas, to'liq oqim o'lchanadi
+    quiz_uids = [5000 + i for i in range(quiz_users)]
+    api = FakeBotAPI(tg_latency, {f"documents/quizdoc{uid}": QUIZ_DOC for uid in quiz_uids})
+    await api.start()
+    ai.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(api.url))
+    fake = FakeGroq(llm_latency)
+    ai.llm.client = fake
+    ai.render_pool.start()
+    ai.extract_pool.start()
+    await ai.db.init()
+    background = [asyncio.create_task(ai.db.batcher.run())]
+    if isinstance(ai.fsm_storage, ai.SQLiteStorage):
+        background.append(asyncio.create_task(ai.fsm_storage.run()))
+
+    update_id = 0
+    latencies = []
+    quiz_times = []
+
+    async def feed(update):
+        nonlocal update_id
+        update_id += 1
+        update['update_id'] = update_id
+        started = time.perf_counter()
+        await ai.dp.feed_raw_update(ai.bot, update)
+        latencies.append(time.perf_counter() - started)
+
+    async def session(uid):
+        # /start -> mavzu -> "7 slayd" tugmasi
+        await feed({'message': {'message_id': 1, 'date': 0, 'chat': _chat(uid), 'from': _user(uid),
+                                'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+        await feed({'message': {'message_id': 2, 'date': 0, 'chat': _chat(uid), 'from': _user(uid),
+                                'text': f"Benchmark mavzusi {uid}"}})
+        await feed({'callback_query': {'id': str(uid), 'from': _user(uid), 'chat_instance': 'b', 'data': 'gen:7',
+                                       'message': {'message_id': 3, 'date': 0, 'chat': _chat(uid), 'text': 'x'}}})
+
+    quiz_button = ai.LANGS['uz']['btns'][ai.MENU_ACTIONS.index('quiz')]
+
+    async def quiz_session(uid):
+        # /start -> "quiz" tugmasi -> PDF hujjat (yuklash, o'qish, LLM, poll'lar)
+        await feed({'message': {'message_id': 1, 'date': 0, 'chat': _chat(uid), 'from': _user(uid),
+                                'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+        await feed({'message': {'message_id': 2, 'date': 0, 'chat': _chat(uid), 'from': _user(uid), 'text': quiz_button}})
+        started = time.perf_counter()
+        await feed({'message': {'message_id': 3, 'date': 0, 'chat': _chat(uid), 'from': _user(uid),
+                                'document': {'file_id': f"quizdoc{uid}", 'file_unique_id': f"quizdoc{uid}",
+                                             'file_name': 'kitob.pdf', 'file_size': len(QUIZ_DOC)}}})
+        quiz_times.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(1000 + i) for i in range(users)), *(quiz_session(uid) for uid in quiz_uids))
+    elapsed = time.perf_counter() - started
+
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await ai.fsm_storage.close()
+    await ai.db.close()
+    ai.render_pool.shutdown()
+    ai.extract_pool.shutdown()
+    await ai.bot.session.close()
+    await api.stop()
+
+    latencies.sort()
+    quiz_times.sort()
+    decks = api.calls.get('sendDocument', 0)
+    if decks < users:
+        print(f"⚠️ {users} ta userdan {decks} tasi deck oldi (navbat/xato)")
+    polls = api.calls.get('sendPoll', 0)
+    quizzes = polls // ai.QUIZ_QUESTION_COUNT
+    if quizzes < quiz_users:
+        print(f"⚠️ {quiz_users} ta userdan {quizzes} tasi to'liq quiz oldi ({polls} ta poll)")
+    results = {
+        'e2e_updates_per_s': len(latencies) / elapsed,
+        'e2e_decks_per_s': decks / elapsed,
+        'e2e_update_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'e2e_update_p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+    if quiz_times:
+        results['e2e_quizzes_per_s'] = quizzes / elapsed
+        results['e2e_quiz_p50_ms'] = quiz_times[len(quiz_times) // 2] * 1000
+    return results
+
+
+# --- BASELINE ---
+def higher_is_better(name):
+    return name.endswith('_per_s')
+
+def compare(results, baseline, tolerance):
+    """Jadval chiqaradi va tolerance'dan ortiq yomonlashgan metrikalar ro'yxatini qaytaradi"""
+    regressions = []
+    print(f"\n{'metrika':34} {'joriy':>12} {'baseline':>12} {'farq':>8}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            print(f"{name:34} {value:12.3f} {'-':>12} {'':>8}")
+            continue
+        change = (value - base) / base
+        worse = -change if higher_is_better(name) else change
+        mark = ''
+        if worse > tolerance and not name.startswith(('deck_kb', 'peak_rss')):
+            regressions.append(name)
+            mark = ' ❌'
+        print(f"{name:34} {value:12.3f} {base:12.3f} {change:+8.1%}{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Slide Master AI tarmoqsiz benchmark")
+    parser.add_argument('--only', choices=['render', 'extract', 'e2e'], action='append')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--pages', type=int, default=100, help="extract korpusidagi sahifalar soni")
+    parser.add_argument('--users', type=int, default=50, help="e2e: parallel userlar (deck)")
+    parser.add_argument('--quiz-users', type=int, default=10, help="e2e: parallel userlar (quiz)")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="soxta LLM javob vaqti (s)")
+    parser.add_argument('--tg-latency', type=float, default=0.005, help="soxta Bot API javob vaqti (s)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.15, help="ruxsat etilgan yomonlashuv (0.15 = 15%%)")
+    args = parser.parse_args()
+    sections = args.only or ['render', 'extract', 'e2e']
+
+    results = {}
+    if 'render' in sections:
+        results.update(bench_render(args.repeat))
+    if 'extract' in sections:
+        results.update(bench_extract(args.pages, args.repeat))
+    if 'e2e' in sections:
+        results.update(asyncio.run(bench_e2e(args.users, args.quiz_users, args.llm_latency, args.tg_latency)))
+    own, children = peak_rss_mb()
+    results['peak_rss_mb'] = own
+    results['peak_rss_children_mb'] = children
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+        print(f"\n💾 Baseline saqlandi: {args.baseline}")
+    elif regressions:
+        print(f"\n❌ Yomonlashgan: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    try:
+        code = main()
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    sys.exit(code)